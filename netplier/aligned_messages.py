@@ -0,0 +1,108 @@
+# This file is part of NetPlier, a tool for binary protocol reverse engineering.
+# Copyright (C) 2021 Yapeng Ye
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>
+
+import os
+import numpy as np
+
+"""
+Aligned messages of a trace, read once from the msa output and shared by all stages
+matrix: the aligned hex chars of each message (one row per message, gaps are '-'), read only
+indexes: the index of each row in the original messages
+ids: the message id of each row
+direction: the direction of each row (0: request; 1: response)
+session_ids: the session id of each row (if the session index is given)
+the rows are sorted by direction (keeping the original order), so requests/responses are views of the matrix
+"""
+class AlignedMessages:
+    GAP = ord('-')
+
+    def __init__(self, matrix, indexes, ids, direction, session_ids=None):
+        self.matrix = matrix
+        self.indexes = indexes
+        self.ids = ids
+        self.direction = direction
+        self.session_ids = session_ids
+        self.num_requests = int((direction == 0).sum())
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    # the aligned length of the messages
+    @property
+    def length(self):
+        return self.matrix.shape[1]
+
+    def __getitem__(self, i):
+        return AlignedMessage(self.ids[i], self.get_data(i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    # the aligned hex string of row i
+    def get_data(self, i):
+        return self.matrix[i].tobytes().decode('ascii')
+
+    def get_gap_mask(self):
+        return self.matrix == AlignedMessages.GAP
+
+    # the view of rows [il, ir)
+    def get_rows(self, il, ir):
+        session_ids = self.session_ids[il:ir] if self.session_ids is not None else None
+        return AlignedMessages(self.matrix[il:ir], self.indexes[il:ir], self.ids[il:ir], self.direction[il:ir], session_ids)
+
+    def get_requests(self):
+        return self.get_rows(0, self.num_requests)
+
+    def get_responses(self):
+        return self.get_rows(self.num_requests, len(self))
+
+    # messages: the original messages; data_list: the aligned hex string of each message
+    @staticmethod
+    def from_data(messages, direction_list, data_list, session_index=None):
+        assert len(messages) == len(data_list), "The num of aligned messages is not the num of messages"
+        assert len(set(len(data) for data in data_list)) <= 1, "The aligned messages don't have same length"
+
+        length = len(data_list[0]) if len(data_list) > 0 else 0
+        matrix = np.frombuffer(''.join(data_list).encode('ascii'), dtype=np.uint8).reshape(len(data_list), length)
+        direction = (np.array(direction_list, dtype=np.int64) != 0).astype(np.int8)
+
+        # requests first, then responses
+        order = np.argsort(direction, kind='stable')
+        matrix = matrix[order]
+        matrix.flags.writeable = False
+        ids = [messages[i].id for i in order]
+        session_ids = session_index.session_ids[order] if session_index is not None else None
+
+        return AlignedMessages(matrix, order, ids, direction[order], session_ids)
+
+    @staticmethod
+    def from_oneline(messages, direction_list, filepath_output_oneline, session_index=None):
+        assert os.path.isfile(filepath_output_oneline), "The msa output oneline file doesn't exist"
+
+        with open(filepath_output_oneline) as f:
+            data_list = f.read().splitlines()
+
+        return AlignedMessages.from_data(messages, direction_list, data_list, session_index)
+
+"""
+A row of AlignedMessages, for the code that reads .id and .data of each message
+"""
+class AlignedMessage:
+
+    def __init__(self, id, data):
+        self.id = id
+        self.data = data
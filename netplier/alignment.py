@@ -17,11 +17,32 @@
 import subprocess
 import os
 import logging
-import copy
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from aligned_messages import AlignedMessages
+from alignment_cache import AlignmentCache
 
 """
 mafft mode: ginsi, linsi, einsi
 details: https://mafft.cbrc.jp/alignment/software/algorithms/algorithms.html
+num_seeds: 0 (default): align all messages with the mode
+           N: align a stratified sample of N messages with the mode, then add the others to this alignment (mafft --add)
+num_partitions: 0 (default): align all messages with the mode
+                N: split the messages into N length bands, align the bands concurrently with the mode, then merge them (mafft --merge)
+encoding: hex (default): each byte is 2 hex chars and "~" in the input of mafft
+          byte: each byte is one symbol (the byte itself) in the input of mafft, the sequences are 3 times shorter
+                the chars that mafft --text can't read are replaced by the symbols in BYTE_SUBSTITUTES,
+                the aligned symbols are changed back to hex from the bytes of the messages
+num_lengths_uniform: 0 (default): always run mafft
+                     N: if the messages have at most N different lengths, mafft is skipped,
+                        the messages are aligned from their first byte (the shorter ones are padded with gaps at the end)
+cache_dir: None (default): no cache
+           path: the oneline output and the fields info are cached in this folder (see AlignmentCache),
+                 the alignment of the same messages with the same options is restored without mafft
+cache_size: the max size of the cache (in bytes, default: 1 GB)
+dedup: False (default): align all messages
+       True: align each unique payload once (messages_input), the aligned rows are copied back to all messages of the payload
 """
 class Alignment:
     FILENAME_INPUT = "msa_input.fa"
@@ -29,13 +50,39 @@ class Alignment:
     FILENAME_OUTPUT_ONELINE = "msa_output_oneline.txt"
     FILENAME_FIELDS_INFO = "msa_fields_info.txt"
     FILENAME_FIELDS_VISUAL = "msa_fields_visual.txt"
-
-    def __init__(self, messages, output_dir='tmp/', mode='ginsi', multithread=False, ep=0.123):
+    FILENAME_SEED_INPUT = "msa_seed_input.fa"
+    FILENAME_SEED_OUTPUT = "msa_seed_output.txt"
+    FILENAME_ADD_INPUT = "msa_add_input.fa"
+    FILENAME_PART_INPUT = "msa_part{}_input.fa"
+    FILENAME_PART_OUTPUT = "msa_part{}_output.txt"
+    FILENAME_MERGE_INPUT = "msa_merge_input.fa"
+    FILENAME_MERGE_TABLE = "msa_merge_table.txt"
+    ENCODING_HEX = "hex"
+    ENCODING_BYTE = "byte"
+    # the chars not allowed by mafft --text (0x00, LF, CR, space, '-', '<', '=', '>') -> substitutes
+    BYTE_SUBSTITUTES = {0x00: 0x80, 0x0a: 0x81, 0x0d: 0x82, 0x20: 0x83, 0x2d: 0x84, 0x3c: 0x85, 0x3d: 0x86, 0x3e: 0x87}
+    BYTE_SYMBOLS = bytes.maketrans(bytes(BYTE_SUBSTITUTES.keys()), bytes(BYTE_SUBSTITUTES.values()))
+    HEX_CHARS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+
+    def __init__(self, messages, output_dir='tmp/', mode='ginsi', multithread=False, ep=0.123, num_seeds=0, num_partitions=0, encoding=ENCODING_HEX, num_lengths_uniform=0, cache_dir=None, cache_size=AlignmentCache.MAX_SIZE, dedup=False):
         self.messages = messages
         self.output_dir = output_dir
         self.mode = mode
         self.multithread = multithread
         self.ep = ep
+        self.num_seeds = num_seeds
+        self.num_partitions = num_partitions
+        self.encoding = encoding
+        self.num_lengths_uniform = num_lengths_uniform
+        self.cache = AlignmentCache(cache_dir, cache_size) if cache_dir is not None else None
+        self.dedup = dedup
+        # the messages given to mafft, and the row of each message in their alignment (None: the same messages)
+        self.messages_input = self.messages
+        self.indexes_input = None
+        if self.dedup:
+            self.messages_input, self.indexes_input = Alignment.get_unique_messages(self.messages)
+        assert self.encoding in [Alignment.ENCODING_HEX, Alignment.ENCODING_BYTE], "the encoding should be hex or byte"
+        assert self.num_seeds <= 0 or self.num_partitions <= 1, "the sample-add and the partitioned alignment can't be used together"
         '''
         self.nthread = nthread
         self.nthreadtb = nthreadtb
@@ -47,23 +94,53 @@ class Alignment:
         self.filepath_output_oneline = os.path.join(self.output_dir, Alignment.FILENAME_OUTPUT_ONELINE)
         self.filepath_fields_info = os.path.join(self.output_dir, Alignment.FILENAME_FIELDS_INFO)
         self.filepath_fields_visual = os.path.join(self.output_dir, Alignment.FILENAME_FIELDS_VISUAL)
+        self.filepath_seed_input = os.path.join(self.output_dir, Alignment.FILENAME_SEED_INPUT)
+        self.filepath_seed_output = os.path.join(self.output_dir, Alignment.FILENAME_SEED_OUTPUT)
+        self.filepath_add_input = os.path.join(self.output_dir, Alignment.FILENAME_ADD_INPUT)
+        self.filepath_merge_input = os.path.join(self.output_dir, Alignment.FILENAME_MERGE_INPUT)
+        self.filepath_merge_table = os.path.join(self.output_dir, Alignment.FILENAME_MERGE_TABLE)
 
     def execute(self):
-        ## Generate msa input (with tilde)
-        self.create_mafft_input_with_tilde()
+        ## Restore the results of the same messages and options
+        if self.cache is not None:
+            key = AlignmentCache.get_key(self.get_cache_options(), self.messages)
+            if self.cache.restore(key, [self.filepath_output_oneline, self.filepath_fields_info]):
+                print("[++++++++] Restore Alignment from cache")
+                self.generate_fields_visual_from_fieldsinfo()
+                return
+
+        if self.is_length_uniform():
+            ## Skip mafft, align the messages from their first byte
+            self.create_mafft_input_encoded()
+            self.create_padded_output()
+        elif 1 < self.num_partitions < len(self.messages_input):
+            ## Align the partitions concurrently, then merge them
+            self.execute_mafft_merge()
+        elif 0 < self.num_seeds < len(self.messages_input):
+            ## Align a sample, then add the other messages
+            self.execute_mafft_add()
+        else:
+            ## Generate msa input (with tilde, or one symbol per byte)
+            self.create_mafft_input_encoded()
 
-        ## Execute Mafft
-        self.execute_mafft()
+            ## Execute Mafft
+            self.execute_mafft()
 
-        ## Change to oneline
-        self.change_to_oneline()
-        ## Remove tilde
-        self.remove_character(self.filepath_output_oneline)
+        ## Change to oneline and remove tilde (in one pass)
+        self.change_to_oneline_without_gaps()
 
         ## Analyze fields
         self.generate_fields_info(self.filepath_output_oneline)
         self.generate_fields_visual_from_fieldsinfo()
 
+        if self.cache is not None:
+            self.cache.store(key, [self.filepath_output_oneline, self.filepath_fields_info])
+
+    # the options that change the alignment results (the key of the cache)
+    def get_cache_options(self):
+        return "mode={0} ep={1} encoding={2} multithread={3} num_seeds={4} num_partitions={5} num_lengths_uniform={6} dedup={7}".format( \
+            self.mode, self.ep, self.encoding, self.multithread, self.num_seeds, self.num_partitions, self.num_lengths_uniform, self.dedup)
+
     ## Create mafft input files
     # hex, without "~"
     def create_mafft_input(self):
@@ -76,31 +153,158 @@ class Alignment:
                 f.write(">{0}\n{1}\n".format(i, message))
 
     # hex, add "~" after each byte
-    def create_mafft_input_with_tilde(self):
-        message_data_hex = list()
-        for message in self.messages:
-            message_data_hex.append(message.data.hex())
-
-        with open(self.filepath_input, 'w') as f:
-            for i, message in enumerate(message_data_hex):
-                message_space = '~'.join(message[j:j+2] for j in range(0, len(message), 2))
-                f.write(">{0}\n{1}\n".format(i, message_space))
+    # indexes: the messages written to the file (default: all), each named by its index
+    def create_mafft_input_with_tilde(self, filepath=None, indexes=None):
+        self.write_mafft_input(self.get_data_with_tilde, filepath, indexes)
+
+    # the input file in the encoding of the alignment
+    def create_mafft_input_encoded(self, filepath=None, indexes=None):
+        self.write_mafft_input(self.get_data_encoded, filepath, indexes)
+
+    def write_mafft_input(self, get_data, filepath=None, indexes=None):
+        filepath = filepath if filepath is not None else self.filepath_input
+        indexes = indexes if indexes is not None else range(len(self.messages_input))
+
+        with open(filepath, 'wb') as f:
+            for i in indexes:
+                f.write(b">%d\n%s\n" % (i, get_data(i)))
+
+    # the hex data of message i with "~" after each byte
+    def get_data_with_tilde(self, i):
+        message = self.messages_input[i].data.hex()
+        return '~'.join(message[j:j+2] for j in range(0, len(message), 2)).encode()
+
+    # the data of message i with one symbol per byte
+    def get_data_with_symbols(self, i):
+        return bytes(self.messages_input[i].data).translate(Alignment.BYTE_SYMBOLS)
+
+    def get_data_encoded(self, i):
+        if self.encoding == Alignment.ENCODING_BYTE:
+            return self.get_data_with_symbols(i)
+        return self.get_data_with_tilde(i)
     
-    def execute_mafft(self):
+    # num_threads: the threads of mafft with multithread (-1: all cores)
+    def execute_mafft(self, filepath_input=None, filepath_output=None, num_threads=-1):
         print("[++++++++] Execute Alignment")
 
         assert self.mode in ["ginsi", "linsi", "einsi"], "the mafft mode should be ginsi, linsi, or einsi"
+        filepath_input = filepath_input if filepath_input is not None else self.filepath_input
+        filepath_output = filepath_output if filepath_output is not None else self.filepath_output
 
         if not self.multithread:
-            cmd = f"mafft-{self.mode} --inputorder --text --ep {self.ep} --quiet {self.filepath_input} > {self.filepath_output}"
+            cmd = f"mafft-{self.mode} --inputorder --text --ep {self.ep} --quiet {filepath_input} > {filepath_output}"
         else:
-            cmd = f"mafft-{self.mode} --thread -1 --inputorder --text --ep {self.ep} --quiet {self.filepath_input} > {self.filepath_output}"
+            cmd = f"mafft-{self.mode} --thread {num_threads} --inputorder --text --ep {self.ep} --quiet {filepath_input} > {filepath_output}"
             #cmd = f"mafft-{self.mode} --thread {self.nthread} --threadtb {self.nthreadtb} --threadit {self.nthreadit} --inputorder --text --ep {self.ep} {self.filepath_input} > {self.filepath_output}"
         logging.debug("mafft cmd: {}".format(cmd))
         
         #run mafft
         result = subprocess.check_output(cmd, shell=True)
 
+    # if the messages have at most num_lengths_uniform different lengths
+    def is_length_uniform(self):
+        if self.num_lengths_uniform <= 0:
+            return False
+        lengths = set(len(message.data) for message in self.messages_input)
+
+        return len(lengths) <= self.num_lengths_uniform
+
+    # the msa output without mafft: each message in the encoding, padded with gaps at the end
+    def create_padded_output(self):
+        print("[++++++++] Skip Alignment (length-uniform messages)")
+        data_list = [self.get_data_encoded(i) for i in range(len(self.messages_input))]
+        length = max((len(data) for data in data_list), default=0)
+
+        with open(self.filepath_output, 'wb') as f:
+            for i, data in enumerate(data_list):
+                f.write(b">%d\n%s\n" % (i, data.ljust(length, b'-')))
+
+    # align the seeds with the mode, then add the other messages to the alignment of the seeds
+    # --keeplength is not used: it would delete the chars of the added messages that are aligned to new columns
+    # the output is ordered by the message indexes in change_to_oneline_without_gaps
+    def execute_mafft_add(self):
+        seeds = self.get_seed_indexes(self.num_seeds)
+        is_seed = np.zeros(len(self.messages_input), dtype=bool)
+        is_seed[seeds] = True
+        logging.debug("[+] Align {0} seeds, then add {1} messages".format(len(seeds), len(self.messages_input) - len(seeds)))
+
+        self.create_mafft_input_encoded(self.filepath_seed_input, seeds.tolist())
+        self.execute_mafft(self.filepath_seed_input, self.filepath_seed_output)
+
+        self.create_mafft_input_encoded(self.filepath_add_input, np.flatnonzero(~is_seed).tolist())
+        thread = "--thread -1 " if self.multithread else ""
+        cmd = f"mafft {thread}--add {self.filepath_add_input} --inputorder --text --ep {self.ep} --quiet {self.filepath_seed_output} > {self.filepath_output}"
+        logging.debug("mafft cmd: {}".format(cmd))
+
+        result = subprocess.check_output(cmd, shell=True)
+
+    # align the partitions with the mode in a thread pool (each mafft is a process), then merge the alignments of the partitions
+    # the partitions of one message are not aligned, mafft --merge aligns them to the merged alignment
+    def execute_mafft_merge(self):
+        partitions = self.get_partitions(self.num_partitions)
+        partitions_aligned = [indexes for indexes in partitions if len(indexes) > 1]
+        logging.debug("[+] Align {0} partitions, then merge them".format(len(partitions)))
+
+        filepaths_input, filepaths_output = list(), list()
+        for k, indexes in enumerate(partitions_aligned):
+            filepaths_input.append(os.path.join(self.output_dir, Alignment.FILENAME_PART_INPUT.format(k)))
+            filepaths_output.append(os.path.join(self.output_dir, Alignment.FILENAME_PART_OUTPUT.format(k)))
+            self.create_mafft_input_encoded(filepaths_input[-1], indexes.tolist())
+
+        # with multithread, the cores are shared by the partitions that are aligned at the same time (all cores are used by the merge)
+        num_workers = max(min(len(partitions_aligned), os.cpu_count() or 1), 1)
+        num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(self.execute_mafft, filepath_input, filepath_output, num_threads) for filepath_input, filepath_output in zip(filepaths_input, filepaths_output)]
+            for future in futures:
+                future.result()
+
+        # the input of --merge: the aligned partitions, then the other messages
+        # the table: the positions (from 1) of the messages of each aligned partition in the input
+        num = 0
+        with open(self.filepath_merge_input, 'wb') as f, open(self.filepath_merge_table, 'w') as ftable:
+            for filepath_output in filepaths_output:
+                with open(filepath_output, 'rb') as fpart:
+                    names, lines = self.parse_msa_output(fpart.read())
+                for name, line in zip(names, lines):
+                    f.write(b">%s\n%s\n" % (name.encode(), line))
+                ftable.write("{0}\n".format(' '.join(str(num + i + 1) for i in range(len(names)))))
+                num += len(names)
+            for indexes in partitions:
+                if len(indexes) == 1:
+                    f.write(b">%d\n%s\n" % (int(indexes[0]), self.get_data_encoded(int(indexes[0]))))
+
+        thread = "--thread -1 " if self.multithread else ""
+        cmd = f"mafft {thread}--merge {self.filepath_merge_table} --inputorder --text --ep {self.ep} --quiet {self.filepath_merge_input} > {self.filepath_output}"
+        logging.debug("mafft cmd: {}".format(cmd))
+
+        result = subprocess.check_output(cmd, shell=True)
+
+    # split the messages into num_partitions length bands of about the same num of messages
+    # output: the message indexes of each partition (sorted by index)
+    def get_partitions(self, num_partitions):
+        num_partitions = max(min(num_partitions, len(self.messages_input)), 1)
+        lengths = np.array([len(message.data) for message in self.messages_input], dtype=np.int64)
+        order = np.lexsort((np.arange(len(self.messages_input)), lengths))
+
+        return [np.sort(indexes) for indexes in np.array_split(order, num_partitions)]
+
+    # a stratified sample of num_seeds messages (sorted by index)
+    # the messages are ordered by (first byte, length, index), then sampled at even steps,
+    # so that each group of messages is sampled in proportion to its size and over its lengths
+    def get_seed_indexes(self, num_seeds):
+        num = len(self.messages_input)
+        num_seeds = min(num_seeds, num)
+        if num_seeds <= 0:
+            return np.zeros(0, dtype=np.int64)
+
+        lengths = np.array([len(message.data) for message in self.messages_input], dtype=np.int64)
+        first_bytes = np.array([message.data[0] if len(message.data) > 0 else -1 for message in self.messages_input], dtype=np.int64)
+        order = np.lexsort((np.arange(num), lengths, first_bytes))
+        positions = np.round(np.linspace(0, num - 1, num_seeds)).astype(np.int64)
+
+        return np.sort(order[positions])
+
     ## process alignment results files
     def change_to_oneline(self):
         logging.debug("[+] Change to oneline")
@@ -119,58 +323,166 @@ class Alignment:
                     else:
                         fout.write("{0}".format(line))
 
+    # the same results as change_to_oneline + remove_character
+    # the msa output is loaded into a matrix, the columns of only '-'/'~' are removed with one mask
+    def change_to_oneline_without_gaps(self):
+        logging.debug("[+] Change to oneline and remove character")
+
+        assert os.path.isfile(self.filepath_output), "The msa output file doesn't exist"
+
+        with open(self.filepath_output, 'rb') as f:
+            names, lines = self.parse_msa_output(f.read())
+
+        # mafft keeps the input order (--inputorder), the names are the message indexes
+        order = list(range(len(names)))
+        if all(name.isdigit() for name in names):
+            order = sorted(order, key=lambda i: int(names[i]))
+            lines = [lines[i] for i in order]
+
+        matrix = self.get_matrix(lines)
+        if self.encoding == Alignment.ENCODING_BYTE:
+            matrix = self.decode_symbols(matrix, [self.messages_input[int(names[i])].data for i in order])
+
+        matrix = self.remove_gap_columns(matrix)
+        # the same row for the messages with the same payload
+        if self.indexes_input is not None:
+            matrix = matrix[self.indexes_input]
+
+        self.write_matrix(matrix, self.filepath_output_oneline)
+
+    # the first message of each payload, the index of the payload of each message
+    @staticmethod
+    def get_unique_messages(messages):
+        dict_data_i = dict()
+        messages_unique = list()
+        indexes = np.empty(len(messages), dtype=np.int64)
+        for i, message in enumerate(messages):
+            data = bytes(message.data)
+            if data not in dict_data_i:
+                dict_data_i[data] = len(messages_unique)
+                messages_unique.append(message)
+            indexes[i] = dict_data_i[data]
+        logging.debug("[+] Unique payloads: {0}/{1}".format(len(messages_unique), len(messages)))
+
+        return messages_unique, indexes
+
+    # aligned symbols (one column per byte) -> aligned hex (2 chars per column, a gap is "--")
+    # the k-th symbol of a row is the k-th byte of its message, the hex is read from the data of the messages
+    @staticmethod
+    def decode_symbols(matrix, messages_data):
+        is_byte = matrix != ord('-')
+        assert np.array_equal(is_byte.sum(axis=1), [len(data) for data in messages_data]), "The aligned symbols are not the bytes of the messages"
+
+        values = np.frombuffer(b''.join(bytes(data) for data in messages_data), dtype=np.uint8)
+        chars = np.full((matrix.shape[0], matrix.shape[1], 2), ord('-'), dtype=np.uint8)
+        chars[is_byte, 0] = Alignment.HEX_CHARS[values >> 4]
+        chars[is_byte, 1] = Alignment.HEX_CHARS[values & 0x0f]
+
+        return chars.reshape(matrix.shape[0], 2 * matrix.shape[1])
+
+    # msa output (fasta) -> names, aligned sequences
+    @staticmethod
+    def parse_msa_output(data):
+        names, lines = list(), list()
+        for record in data.split(b'>')[1:]:
+            name, _, sequence = record.partition(b'\n')
+            names.append(name.strip().decode())
+            lines.append(sequence.replace(b'\n', b'').replace(b'\r', b''))
+
+        return names, lines
+
     def remove_character(self, filepath):
         logging.debug("[+] Remove character")
 
         assert os.path.isfile(filepath), "The file doesn't exist: {}".format(filepath)
 
-        with open(filepath) as f:
+        with open(filepath, 'rb') as f:
             linelist = f.read().splitlines()
 
-        results = [list() for i in range(len(linelist))]
+        self.write_matrix(self.remove_gap_columns(self.get_matrix(linelist)), filepath)
 
-        for i in range(len(linelist[0])):
-            isToDelete = True
-            for line in linelist:
-                if line[i] != '-' and line[i] != '~':
-                    isToDelete = False
-                    break
-            if not isToDelete:
-                for j,line in enumerate(linelist):
-                    #print("{0} {1}".format(i, j))
-                    results[j].append(line[i])
+    # aligned lines (bytes, with the same length) -> matrix of chars
+    @staticmethod
+    def get_matrix(lines):
+        assert len(set(len(line) for line in lines)) <= 1, "The aligned messages don't have same length"
+        length = len(lines[0]) if len(lines) > 0 else 0
+
+        return np.frombuffer(b''.join(lines), dtype=np.uint8).reshape(len(lines), length)
 
-        with open(filepath, 'w') as fout:
-            for line in results:
-                fout.write("{0}\n".format(''.join(line)))
+    # remove the columns that only have '-' or '~'
+    @staticmethod
+    def remove_gap_columns(matrix):
+        is_gap = (matrix == ord('-')) | (matrix == ord('~'))
+        return matrix[:, ~is_gap.all(axis=0)]
+
+    # write each row of the matrix as a line
+    @staticmethod
+    def write_matrix(matrix, filepath):
+        lines = np.empty((matrix.shape[0], matrix.shape[1] + 1), dtype=np.uint8)
+        lines[:, :-1] = matrix
+        lines[:, -1] = ord('\n')
+
+        with open(filepath, 'wb') as fout:
+            fout.write(lines.tobytes())
 
     ## Analyze fields
+    # a field is the shortest window (>= 2 chars) that has an even number of non-gap chars in every message
+    # S: the same value in all messages (adjacent static fields are merged), V: with gaps, D: others
+    # the window checks are done with prefix sums over the columns:
+    #   parity[:, j]: the parity of the num of non-gap chars in data[:j] of each message,
+    #   data[i:j] is even in every message iff parity[:, i] == parity[:, j]
     def generate_fields_info(self, filepath_input):
         logging.debug("[+] Generate fields info")
         
         assert os.path.isfile(filepath_input), "The file doesn't exist: {}".format(filepath_input)
 
-        with open(filepath_input) as f:
-            linelist = f.read().splitlines()
+        with open(filepath_input, 'rb') as f:
+            matrix = self.get_matrix(f.read().splitlines())
 
-        length_message = len(linelist[0])
+        length_message = matrix.shape[1]
+        is_gap = matrix == ord('-')
+
+        # the positions j > i with the same parity vector as i, in order: next_same[i], next_same[next_same[i]], ...
+        parity = np.zeros((matrix.shape[0], length_message + 1), dtype=np.uint8)
+        np.cumsum(~is_gap, axis=1, out=parity[:, 1:])
+        parity &= 1
+        _, parity_ids = np.unique(np.packbits(parity, axis=0).T, axis=0, return_inverse=True)
+        parity_ids = parity_ids.reshape(-1)
+        positions = np.lexsort((np.arange(length_message + 1), parity_ids))
+        next_same = np.full(length_message + 1, length_message + 1, dtype=np.int64)
+        is_next = parity_ids[positions[1:]] == parity_ids[positions[:-1]]
+        next_same[positions[:-1][is_next]] = positions[1:][is_next]
+
+        # prefix sums of the columns that are not constant / have gaps
+        nonconstant_sum = np.concatenate(([0], np.cumsum(~(matrix == matrix[:1]).all(axis=0))))
+        gap_sum = np.concatenate(([0], np.cumsum(is_gap.any(axis=0))))
 
         ## Only record fields info
         results_fields = list()
 
         i = 0
         isLastStatic = False
+        window = None # the values of the last tested window: data[il:ir]
         while i < length_message:
             offset = 2
-            while i + offset <= length_message:
-                valuelist = [line[i:i+offset] for line in linelist]
-                if not self.has_even_number_of_bytes(valuelist):
-                    offset += 1
-                    continue
+            if i + offset <= length_message:
+                j = int(next_same[i])
+                if j == i + 1:
+                    j = int(next_same[j])
+                if j <= length_message:
+                    offset = j - i
+                    window = (i, j)
                 else:
-                    break
-            if not len(set(valuelist)) == 1:
-                if self.is_variable_field(valuelist):
+                    # no even window, the field is the rest of the messages
+                    offset = length_message - i + 1
+                    window = (i, length_message)
+            elif window is None:
+                window = (i, length_message)
+            # else: the values of the last field are tested again
+
+            il, ir = window
+            if nonconstant_sum[ir] - nonconstant_sum[il] > 0:
+                if gap_sum[ir] - gap_sum[il] > 0:
                     fields_info = [offset, 'V']
                 else:
                     fields_info = [offset, 'D']
@@ -240,15 +552,6 @@ class Alignment:
 
         return fields_info
 
-    @staticmethod
-    def get_messages_aligned(messages, filepath_output_oneline):
-        assert os.path.isfile(filepath_output_oneline), "The msa output oneline file doesn't exist"
-
-        messages_aligned = copy.deepcopy(messages)
-        with open(filepath_output_oneline) as f:
-            messages_aligned_data = f.read().splitlines()
-
-        for i in range(len(messages_aligned)):
-            messages_aligned[i].data = messages_aligned_data[i]
-
-        return messages_aligned
+    # the aligned messages as a matrix, read once and shared by all stages
+    def get_aligned_messages(self, direction_list, session_index=None):
+        return AlignedMessages.from_oneline(self.messages, direction_list, self.filepath_output_oneline, session_index)
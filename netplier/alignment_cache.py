@@ -0,0 +1,108 @@
+# This file is part of NetPlier, a tool for binary protocol reverse engineering.
+# Copyright (C) 2021 Yapeng Ye
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>
+
+import os
+import shutil
+import hashlib
+import logging
+
+"""
+On-disk cache of alignment results, shared by the runs on the same messages with the same alignment options
+cache_dir: each entry is the folder cache_dir/key with the cached files (key: sha256 of the options and the messages)
+max_size: the max size of all entries (in bytes), the least recently used entries are removed first
+an entry is used when it is restored or stored (its mtime is the time of the last use)
+"""
+class AlignmentCache:
+    MAX_SIZE = 1024 * 1024 * 1024
+
+    def __init__(self, cache_dir, max_size=MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    # options: the alignment options (str); messages: the messages in order
+    @staticmethod
+    def get_key(options, messages):
+        h = hashlib.sha256()
+        h.update(options.encode())
+        for message in messages:
+            data = bytes(message.data)
+            h.update(len(data).to_bytes(8, 'little'))
+            h.update(data)
+
+        return h.hexdigest()
+
+    # copy the cached files of key to filepaths (the files are matched by name)
+    # output: if the entry is found
+    def restore(self, key, filepaths):
+        entry_dir = os.path.join(self.cache_dir, key)
+        if not all(os.path.isfile(os.path.join(entry_dir, os.path.basename(filepath))) for filepath in filepaths):
+            return False
+
+        for filepath in filepaths:
+            shutil.copyfile(os.path.join(entry_dir, os.path.basename(filepath)), filepath)
+        os.utime(entry_dir)
+        logging.debug("[+] Restore alignment from cache: {}".format(key))
+
+        return True
+
+    # copy filepaths to the entry of key, then remove the least recently used entries
+    def store(self, key, filepaths):
+        entry_dir = os.path.join(self.cache_dir, key)
+        # the files are copied to a temporary folder first, so that an entry is never read while it is written
+        tmp_dir = os.path.join(self.cache_dir, ".tmp-{0}-{1}".format(key, os.getpid()))
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for filepath in filepaths:
+            shutil.copyfile(filepath, os.path.join(tmp_dir, os.path.basename(filepath)))
+
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # stored by another run
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        logging.debug("[+] Store alignment in cache: {}".format(key))
+
+        self.evict(keep=key)
+
+    # remove the least recently used entries until the size of the cache is at most max_size
+    def evict(self, keep=None):
+        entries = list()
+        for key in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, key)
+            if key.startswith('.') or not os.path.isdir(entry_dir):
+                continue
+            # the entry may be removed by another run
+            try:
+                size = sum(os.path.getsize(os.path.join(entry_dir, filename)) for filename in os.listdir(entry_dir))
+                entries.append((os.path.getmtime(entry_dir), key, size))
+            except OSError:
+                continue
+
+        size_total = sum(size for _, _, size in entries)
+        for _, key, size in sorted(entries):
+            if size_total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            try:
+                shutil.rmtree(os.path.join(self.cache_dir, key))
+            except OSError:
+                continue
+            size_total -= size
+            logging.debug("[+] Remove alignment from cache: {}".format(key))
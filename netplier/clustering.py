@@ -17,12 +17,16 @@
 import numpy as np
 from sklearn import metrics
 import logging
-import struct
+
+from field_layout import FieldLayout
+from aligned_messages import AlignedMessages
+from protocol_spec import ProtocolSpec
 
 class Clustering:
-    def __init__(self, fields, protocol_type):
+    def __init__(self, fields, protocol_type, field_layout=None):
         self.fields = fields
         self.protocol_type = protocol_type
+        self.field_layout = field_layout if field_layout is not None else FieldLayout.from_fields(fields)
         
     def evaluation(self, clustering_result_true, clustering_result_method):
         print("[++++++++] Evaluate Clustering results")
@@ -74,52 +78,32 @@ class Clustering:
             logging.error("The protocol_type (-t) is required for computing the true clustering")
             return results
         
-        for message in messages:
-            kw = self.get_true_keyword(message)
-            results.append(kw)
-        
-        return results
+        results = ProtocolSpec.get(self.protocol_type).get_keywords(messages)
 
-    def get_true_keyword(self, message):
-        if self.protocol_type == "dhcp":
-            kw = message.data[242:243]
-        elif self.protocol_type == "dnp3":
-            kw = message.data[12:13]
-        elif self.protocol_type == "ftp":
-            kw = re.split(" |-|\r|\n", message.data.decode())[0]
-        elif self.protocol_type == "icmp":
-            kw = message.data[0:2]
-        elif self.protocol_type == "modbus":
-            kw = message.data[7:8]
-        elif self.protocol_type == "ntp":
-            kw = message.data[0] & 0x07
-        elif self.protocol_type == "smb":
-            kw = message.data[4+4]
-        elif self.protocol_type == "smb2":
-            kw = struct.unpack("<H", message.data[4+12:4+12+2])[0]
-        elif self.protocol_type == "tftp":
-            kw = message.data[0:2]
-        elif self.protocol_type == "zeroaccess":
-            kw = message.data[4:8]
-        else:
-            logging.error("The protocol_type is unknown")
-
-        if type(kw).__name__ == "bytes":
-            kw = str(kw.hex())
-        
-        return kw
+        return results
 
     def cluster_by_kw_inferred(self, fid_inferred_list, messages):
         print("[++++++++] Cluster by Inferred Keyword")
+        if isinstance(messages, AlignedMessages):
+            return self.cluster_by_kw_inferred_matrix(fid_inferred_list, messages)
+
         results = [list() for message in messages]
         for fid_inferred in fid_inferred_list:
-            il, ir = 0, 0
-            for i in range(fid_inferred):
-                il += self.fields[i].domain.dataType.size[1] // 8
-            ir = il + (self.fields[fid_inferred].domain.dataType.size[1] // 8)
+            il, ir = self.field_layout.get_range(fid_inferred)
 
             for j in range(len(messages)):
                 results[j].append(messages[j].data[il:ir])
         results = [''.join(result) for result in results]
 
         return results
+
+    # the same as cluster_by_kw_inferred, the keyword columns are sliced from the matrix of aligned messages
+    def cluster_by_kw_inferred_matrix(self, fid_inferred_list, messages):
+        columns_list = [messages.matrix[:, slice(*self.field_layout.get_range(fid_inferred))] for fid_inferred in fid_inferred_list]
+        if len(columns_list) == 0:
+            return ['' for i in range(len(messages))]
+        kw_matrix = np.ascontiguousarray(np.concatenate(columns_list, axis=1))
+        kw_width = kw_matrix.shape[1]
+        kw_data = kw_matrix.tobytes().decode('ascii')
+
+        return [kw_data[i*kw_width:(i+1)*kw_width] for i in range(len(messages))]
@@ -16,44 +16,73 @@
 
 import os
 import logging
-import copy
-import collections
-import gc
+import binascii
+import hashlib
+import multiprocessing
+import numpy as np
+try:
+    from multiprocessing import shared_memory
+except ImportError: # python < 3.8
+    shared_memory = None
 
-from netzob.Model.Vocabulary.Symbol import Symbol
-from netzob.Model.Vocabulary.Field import Field
-from netzob.Model.Vocabulary.Types.Raw import Raw
 #from netzob.Import.PCAPImporter.all import *
 #from netzob.Model.Vocabulary.Session import Session
 
-from processing import Processing
 from alignment import Alignment
+from session_index import SessionIndex
+from partition import Partition
+from field_layout import FieldLayout
+from aligned_messages import AlignedMessages
 from constraint.message_similarity import MessageSimilarity
 from constraint.remote_coupling import RemoteCoupling
 
+# the state of each worker process (set by Constraint.init_worker)
+worker_state = dict()
+
 class Constraint:
     TEST_TYPE_REQUEST = 0
     TEST_TYPE_RESPONSE = 1
     #FILENAME_P_REQUEST = "prob_request.txt"
     #FILENAME_P_RESPONSE = "prob_response.txt"
+    # the field pairs (request-response) to be tested: only the same field on both sides, or all combinations
+    PAIRS_DIAGONAL = "diagonal"
+    PAIRS_FULL = "full"
+    # the arrays of MessageSimilarity that are shared with the worker processes
+    SHARED_SIMILARITY_ARRAYS = ["similarity_matrix", "match_matrix", "score_histograms"]
 
-    def __init__(self, messages, direction_list, fields, fid_list, output_dir='tmp/'):
+    def __init__(self, messages, direction_list, fields, fid_list, output_dir='tmp/', session_index=None, num_workers=1, field_layout=None, messages_aligned=None):
         self.messages = messages
         self.direction_list = direction_list
         self.fields = fields
         self.fid_list = fid_list
         self.output_dir = output_dir
-
-    def compute_observation_probabilities(self):
+        self.session_index = session_index
+        self.num_workers = num_workers # num of processes used to test the candidate fields
+        self.gap_masks = None # the gap mask of the aligned requests/responses
+        self.pair_rows = None # the rows of the messages of the session pairs in the aligned requests/responses
+        self.field_layout = field_layout if field_layout is not None else FieldLayout.from_fields(fields)
+        self.messages_aligned = messages_aligned # AlignedMessages, read from the msa output if it is not given
+        self.pairs_range = None # the range of the observation probs of all pairs (set by compute_observation_probabilities)
+
+    # pairs: Constraint.PAIRS_FULL, Constraint.PAIRS_DIAGONAL, or a list of fid pairs ("fid_request-fid_response")
+    def compute_observation_probabilities(self, pairs=PAIRS_FULL):
         print("[++++++++] Compute probabilities of observation constraints")
-        messages_aligned = Alignment.get_messages_aligned(self.messages, os.path.join(self.output_dir, Alignment.FILENAME_OUTPUT_ONELINE))
-        messages_request, messages_response = Processing.divide_msgs_by_directionlist(self.messages, self.direction_list)
-        messages_request_aligned, messages_response_aligned = Processing.divide_msgs_by_directionlist(messages_aligned, self.direction_list)
-
-        fid_list_request = self.filter_fields(self.fields, self.fid_list, messages_request_aligned)
-        fid_list_response = self.filter_fields(self.fields, self.fid_list, messages_response_aligned)
+        # sessions are shared by the remote coupling of all field pairs
+        if self.session_index is None:
+            self.session_index = SessionIndex(self.messages, self.direction_list)
+        if self.messages_aligned is None:
+            self.messages_aligned = AlignedMessages.from_oneline(self.messages, self.direction_list, \
+                os.path.join(self.output_dir, Alignment.FILENAME_OUTPUT_ONELINE), self.session_index)
+        messages_request_aligned, messages_response_aligned = self.messages_aligned.get_requests(), self.messages_aligned.get_responses()
+
+        fid_list_request = self.filter_fields(self.fid_list, messages_request_aligned)
+        fid_list_response = self.filter_fields(self.fid_list, messages_response_aligned)
         logging.debug("request candidate fid: {}\nresponse candidate fid: {}".format(fid_list_request, fid_list_response))
 
+        # all candidate fields are clustered, only the remote coupling is limited to the selected pairs
+        field_pairs = self.select_field_pairs(pairs, fid_list_request, fid_list_response)
+        logging.debug("Number of field pairs: {}".format(len(field_pairs)))
+
         # compute matrix of similarity scores
         constraint_m_request, constraint_m_response = MessageSimilarity(messages = messages_request_aligned), MessageSimilarity(messages = messages_response_aligned)
         constraint_m_request.compute_similarity_matrix()
@@ -67,87 +96,250 @@ class Constraint:
         pairs_p_request, pairs_p_response = dict(), dict()
         pairs_size_request, pairs_size_response = dict(), dict()
 
-        for fid_request in fid_list_request:
-            logging.info("[++++] Test Request Field {0}-*".format(fid_request))
+        # compute prob of m,s,d,v of each candidate field
+        self.gap_masks = [messages_request_aligned.get_gap_mask(), messages_response_aligned.get_gap_mask()]
+        self.pair_rows = self.get_pair_rows([messages_request_aligned, messages_response_aligned])
+        # the symbol index of the request/response of each session pair: {fid: array}
+        cluster_pair_labels_request, cluster_pair_labels_response = dict(), dict()
+        tasks = [(Constraint.TEST_TYPE_RESPONSE, fid) for fid in fid_list_response] + [(Constraint.TEST_TYPE_REQUEST, fid) for fid in fid_list_request]
+        messages_aligned_list = [messages_request_aligned, messages_response_aligned]
+        constraint_m_list = [constraint_m_request, constraint_m_response]
+        if self.num_workers > 1 and shared_memory is None:
+            logging.error("Shared memory is not supported (python >= 3.8 is required). Test the fields in one process.")
+        if self.num_workers > 1 and shared_memory is not None and len(tasks) > 1:
+            results = self.compute_field_probabilities_parallel(tasks, messages_aligned_list, constraint_m_list)
+        else:
+            results = [self.compute_field_probabilities(direction, fid, messages_aligned_list[direction], constraint_m_list[direction]) for direction, fid in tasks]
+
+        for (direction, fid), (cluster_p, cluster_size, pair_labels) in zip(tasks, results):
+            if direction == Constraint.TEST_TYPE_REQUEST:
+                cluster_p_request[fid], cluster_size_request[fid], cluster_pair_labels_request[fid] = cluster_p, cluster_size, pair_labels
+            else:
+                cluster_p_response[fid], cluster_size_response[fid], cluster_pair_labels_response[fid] = cluster_p, cluster_size, pair_labels
+
+        fid_request_last = None
+        for fid_request, fid_response in field_pairs:
+            if fid_request != fid_request_last:
+                logging.info("[++++] Test Request Field {0}-*".format(fid_request))
+                pair_labels_request = cluster_pair_labels_request[fid_request]
+                fid_request_last = fid_request
+
+            logging.debug("[++] Test Response Field {0}-{1}".format(fid_request, fid_response))
+
+            # compute remote coupling probabilities
+            fid_pair = "{}-{}".format(fid_request, fid_response)
+            p_r_request, p_r_response = RemoteCoupling.compute_constraint_remote_coupling_by_pair_labels(pair_labels_request, cluster_pair_labels_response[fid_response], \
+                len(cluster_size_request[fid_request]), len(cluster_size_response[fid_response]))
+
+            logging.debug("[+] Observation Prob Results for pairs {}".format(fid_pair))
+            p_m, p_s, p_d, p_v = cluster_p_request[fid_request][0], cluster_p_request[fid_request][1], cluster_p_request[fid_request][2], cluster_p_request[fid_request][3]
+            logging.debug("Request:\nPm: {0}\nPr: {1}\nPs: {2}\nPd: {3}\nPv: {4}".format(p_m, p_r_request, p_s, p_d, p_v))
+            pairs_p_request[fid_pair] = [p_m, p_r_request, p_s, p_d, p_v]
+            pairs_size_request[fid_pair] = cluster_size_request[fid_request]
+            
+            p_m, p_s, p_d, p_v = cluster_p_response[fid_response][0], cluster_p_response[fid_response][1], cluster_p_response[fid_response][2], cluster_p_response[fid_response][3]
+            logging.debug("Response:\nPm: {0}\nPr: {1}\nPs: {2}\nPd: {3}\nPv: {4}".format(p_m, p_r_response, p_s, p_d, p_v))
+            pairs_p_response[fid_pair] = [p_m, p_r_response, p_s, p_d, p_v]
+            pairs_size_response[fid_pair] = cluster_size_response[fid_response]
 
-            # merge other fields
-            fields_merged_request = self.merge_nontest_fields(self.fields, fid_request)
-            fid_merged_request = 0 if fid_request == 0 else 1
+        pairs_p = [pairs_p_request, pairs_p_response]
+        pairs_size = [pairs_size_request, pairs_size_response]
 
-            # generate clusters
-            symbols_request_aligned = self.cluster_by_field(fields_merged_request, messages_request_aligned, fid_merged_request)
-            # change symbol names
-            symbols_request_aligned = self.change_symbol_name(symbols_request_aligned)
+        # the normalization range of the selected pairs is the same as the one of all pairs
+        self.pairs_range = self.compute_pairs_range(pairs_p, [cluster_p_request, cluster_p_response], \
+            [cluster_pair_labels_request, cluster_pair_labels_response], [cluster_size_request, cluster_size_response], \
+            fid_list_request, fid_list_response, field_pairs)
 
-            # compute prob of m,s,d,v
-            cluster_p_request[fid_request] = list()
-            cluster_p_request[fid_request].append(constraint_m_request.compute_constraint_message_similarity(symbols_request_aligned))
-            cluster_p_request[fid_request].append(self.compute_constraint_structure(symbols_request_aligned))
-            cluster_p_request[fid_request].append(self.compute_constraint_dimension(symbols_request_aligned))
-            cluster_p_request[fid_request].append(self.compute_constraint_value(symbols_request_aligned))
-            cluster_size_request[fid_request] = [len(s.messages) for s in symbols_request_aligned.values()]
+        return pairs_p, pairs_size
 
+    # the (min, max) of the valid (>= 0) probs of m/r/s/d over all pairs of the candidate fields: [{test_id: (min, max)}] for requests and responses
+    # the r of the pairs that are not selected are only computed while the r of all computed pairs are the same (r is normalized in [0, 1] otherwise)
+    def compute_pairs_range(self, pairs_p, cluster_p_list, cluster_pair_labels_list, cluster_size_list, fid_list_request, fid_list_response, field_pairs):
+        pairs_range = [dict(), dict()]
+        if len(fid_list_request) == 0 or len(fid_list_response) == 0:
+            return pairs_range
+
+        fid_lists = [fid_list_request, fid_list_response]
+        for direction in [Constraint.TEST_TYPE_REQUEST, Constraint.TEST_TYPE_RESPONSE]:
+            # test_id: 0: m, 1: r, 2: s, 3: d; the cluster probs are [pm,ps,pd,pv]
+            for test_id, i in [(0, 0), (2, 1), (3, 2)]:
+                pairs_range[direction][test_id] = Constraint.get_p_range([cluster_p_list[direction][fid][i] for fid in fid_lists[direction]])
+            pairs_range[direction][1] = Constraint.get_p_range([p_lists[1] for p_lists in pairs_p[direction].values()])
+
+        field_pairs_selected = set(field_pairs)
+        for fid_request in fid_list_request:
             for fid_response in fid_list_response:
-                #if fid_request != fid_response:
-                #    continue
-                logging.debug("[++] Test Response Field {0}-{1}".format(fid_request, fid_response))
-
-                # merge other fields
-                fields_merged_response = self.merge_nontest_fields(self.fields, fid_response)
-                fid_merged_response = 0 if fid_response == 0 else 1
-
-                # generate clusters
-                symbols_response_aligned = self.cluster_by_field(fields_merged_response, messages_response_aligned, fid_merged_response)
-                # change symbol names
-                symbols_response_aligned = self.change_symbol_name(symbols_response_aligned)
-
-                # compute prob of m,s,d,v
-                if fid_response not in cluster_p_response:
-                    cluster_p_response[fid_response] = list()
-                    cluster_p_response[fid_response].append(constraint_m_response.compute_constraint_message_similarity(symbols_response_aligned))
-                    cluster_p_response[fid_response].append(self.compute_constraint_structure(symbols_response_aligned))
-                    cluster_p_response[fid_response].append(self.compute_constraint_dimension(symbols_response_aligned))
-                    cluster_p_response[fid_response].append(self.compute_constraint_value(symbols_response_aligned))
-                    cluster_size_response[fid_response] = [len(s.messages) for s in symbols_response_aligned.values()]
-
-                # print msg numbers of each cluster
-                logging.debug("Number of request symbols: {0}".format(len(symbols_request_aligned.values())))
-                for s in symbols_request_aligned.values():
-                    logging.debug("  Symbol {0} msgs numbers: {1}".format(str(s.name), len(s.messages)))
-                logging.debug("Number of response symbols: {0}".format(len(symbols_response_aligned.values())))
-                for s in symbols_response_aligned.values():
-                    logging.debug("  Symbol {0} msgs numbers: {1}".format(str(s.name), len(s.messages)))
-
-                # compute remote coupling probabilities
-                rc = RemoteCoupling(messages_all=messages_aligned, symbols_request=symbols_request_aligned, symbols_response=symbols_response_aligned, direction_list=self.direction_list)
-                rc.compute_pairs_by_directionlist()
-                fid_pair = "{}-{}".format(fid_request, fid_response)
-                p_r_request = rc.compute_constraint_remote_coupling(RemoteCoupling.TEST_TYPE_REQUEST)
-                p_r_response = rc.compute_constraint_remote_coupling(RemoteCoupling.TEST_TYPE_RESPONSE)
-
-                logging.debug("[+] Observation Prob Results for pairs {}".format(fid_pair))
-                p_m, p_s, p_d, p_v = cluster_p_request[fid_request][0], cluster_p_request[fid_request][1], cluster_p_request[fid_request][2], cluster_p_request[fid_request][3]
-                logging.debug("Request:\nPm: {0}\nPr: {1}\nPs: {2}\nPd: {3}\nPv: {4}".format(p_m, p_r_request, p_s, p_d, p_v))
-                pairs_p_request[fid_pair] = [p_m, p_r_request, p_s, p_d, p_v]
-                pairs_size_request[fid_pair] = cluster_size_request[fid_request]
-                
-                p_m, p_s, p_d, p_v = cluster_p_response[fid_response][0], cluster_p_response[fid_response][1], cluster_p_response[fid_response][2], cluster_p_response[fid_response][3]
-                logging.debug("Response:\nPm: {0}\nPr: {1}\nPs: {2}\nPd: {3}\nPv: {4}".format(p_m, p_r_response, p_s, p_d, p_v))
-                pairs_p_response[fid_pair] = [p_m, p_r_response, p_s, p_d, p_v]
-                pairs_size_response[fid_pair] = cluster_size_response[fid_response]
-                
-                del rc
-                del symbols_response_aligned #symbols
-                del fields_merged_response
-                gc.collect()
-            del symbols_request_aligned
-            del fields_merged_request
-            gc.collect()
+                if all(p_range is not None and p_range[0] != p_range[1] for p_range in [pairs_range[0][1], pairs_range[1][1]]):
+                    return pairs_range
+                if (fid_request, fid_response) in field_pairs_selected:
+                    continue
+                p_r_lists = RemoteCoupling.compute_constraint_remote_coupling_by_pair_labels(cluster_pair_labels_list[0][fid_request], cluster_pair_labels_list[1][fid_response], \
+                    len(cluster_size_list[0][fid_request]), len(cluster_size_list[1][fid_response]))
+                for direction in [Constraint.TEST_TYPE_REQUEST, Constraint.TEST_TYPE_RESPONSE]:
+                    pairs_range[direction][1] = Constraint.get_p_range([p_r_lists[direction]], pairs_range[direction][1])
+
+        return pairs_range
+
+    # the (min, max) of the valid (>= 0) probs in p_lists, merged with p_range (None: no valid prob)
+    @staticmethod
+    def get_p_range(p_lists, p_range=None):
+        p_list_total = [p for p_list in p_lists for p in p_list if p >= 0]
+        if p_range is not None:
+            p_list_total += list(p_range)
+        if len(p_list_total) == 0:
+            return None
+
+        return min(p_list_total), max(p_list_total)
+
+    # the (fid_request, fid_response) pairs to be tested, in the order of request fields and then response fields
+    # pairs of fields that are not candidates on both sides are skipped
+    def select_field_pairs(self, pairs, fid_list_request, fid_list_response):
+        if pairs == Constraint.PAIRS_FULL:
+            return [(fid_request, fid_response) for fid_request in fid_list_request for fid_response in fid_list_response]
+        if pairs == Constraint.PAIRS_DIAGONAL:
+            return [(fid, fid) for fid in fid_list_request if fid in fid_list_response]
+
+        assert isinstance(pairs, (list, tuple, set)), "pairs should be full, diagonal or a list of fid pairs"
+        pairs_selected = set()
+        for fid_pair in pairs:
+            fid_request, fid_response = fid_pair.split('-') if isinstance(fid_pair, str) else fid_pair
+            pairs_selected.add((int(fid_request), int(fid_response)))
+        field_pairs = [(fid_request, fid_response) for fid_request in fid_list_request for fid_response in fid_list_response \
+            if (fid_request, fid_response) in pairs_selected]
+        if len(field_pairs) < len(pairs_selected):
+            logging.debug("Skip the pairs of non-candidate fields: {}".format(sorted(pairs_selected - set(field_pairs))))
+        return field_pairs
+
+    # generate the clusters of the messages by the field fid
+    def generate_symbols(self, fid, messages):
+        # the other fields are not tested, only the range of the test field is needed
+        il, ir = self.field_layout.get_range(fid)
+
+        # generate clusters
+        symbols = self.cluster_by_field(messages, il, ir)
+        # change symbol names
+        symbols = self.change_symbol_name(symbols)
 
-        pairs_p = [pairs_p_request, pairs_p_response]
-        pairs_size = [pairs_size_request, pairs_size_response]
+        return symbols
 
-        return pairs_p, pairs_size
+    # cluster the messages by the field fid
+    # output: the observation prob of each cluster, the size of each cluster, the symbol index of the messages in the session pairs
+    def compute_field_probabilities(self, direction, fid, messages, constraint_m):
+        test_type = "Request" if direction == Constraint.TEST_TYPE_REQUEST else "Response"
+        logging.debug("[++] Test {0} Field {1}".format(test_type, fid))
+        symbols = self.generate_symbols(fid, messages)
+
+        # compute prob of m,s,d,v
+        gap_mask = self.gap_masks[direction] if self.gap_masks is not None else None
+        cluster_p = self.compute_cluster_probabilities(symbols, constraint_m, gap_mask)
+        cluster_size = symbols.sizes.tolist()
+        pair_labels = symbols.labels[self.pair_rows[direction]]
+
+        # print msg numbers of each cluster
+        logging.debug("Number of {0} symbols: {1}".format(test_type.lower(), len(symbols)))
+        for sn, size in zip(symbols.names, cluster_size):
+            logging.debug("  Symbol {0} msgs numbers: {1}".format(sn, size))
+
+        return cluster_p, cluster_size, pair_labels
+
+    # the row of each message of the session pairs in the aligned requests/responses: [rows_request, rows_response]
+    # the requests of the pairs are aligned requests and the responses are aligned responses
+    def get_pair_rows(self, messages_aligned_list):
+        pair_rows = list()
+        for messages, messages_pairs in zip(messages_aligned_list, self.session_index.get_request_response_pairs()):
+            rows = np.full(len(self.session_index.session_ids), -1, dtype=np.int64)
+            rows[messages.indexes] = np.arange(len(messages))
+            pair_rows.append(rows[messages_pairs])
+
+        return pair_rows
+
+    # the same results as compute_field_probabilities for each task (direction, fid), computed by a process pool
+    # the aligned messages, the gap masks and the similarity matrices are shared with the workers through shared memory
+    # the workers only get the field layout and the session pairs, not the constraint (with the netzob messages and fields)
+    def compute_field_probabilities_parallel(self, tasks, messages_aligned_list, constraint_m_list):
+        shm_list, shared_info_list = list(), list()
+        for messages, gap_mask, constraint_m in zip(messages_aligned_list, self.gap_masks, constraint_m_list):
+            if constraint_m.eer_mode == MessageSimilarity.EER_HISTOGRAM and constraint_m.match_matrix is not None and constraint_m.score_histograms is None:
+                constraint_m.compute_score_histograms()
+            arrays_messages = {'matrix': messages.matrix, 'indexes': messages.indexes, 'direction': messages.direction}
+            arrays_similarity = {name: getattr(constraint_m, name) for name in Constraint.SHARED_SIMILARITY_ARRAYS if getattr(constraint_m, name) is not None}
+
+            shared_info = {'ids': messages.ids, 'engine': constraint_m.engine, 'eer_mode': constraint_m.eer_mode, 'length': constraint_m.length}
+            for key, arrays in [('messages', arrays_messages), ('similarity', arrays_similarity), ('gap_mask', {'gap_mask': gap_mask})]:
+                shared_info[key] = dict()
+                for name, array in arrays.items():
+                    shm, shared_info[key][name] = Constraint.share_array(np.asarray(array))
+                    shm_list.append(shm)
+            shared_info_list.append(shared_info)
+        state = {'field_layout': self.field_layout, 'pair_rows': self.pair_rows}
+
+        try:
+            with multiprocessing.Pool(processes=self.num_workers, initializer=Constraint.init_worker, initargs=(state, shared_info_list)) as pool:
+                results = pool.map(Constraint.compute_field_probabilities_worker, tasks, chunksize=1)
+        finally:
+            for shm in shm_list:
+                shm.close()
+                shm.unlink()
+
+        return results
+
+    # rebuild the aligned messages and the similarity matrices of each direction from the shared memory
+    @staticmethod
+    def init_worker(state, shared_info_list):
+        constraint = Constraint(messages=None, direction_list=None, fields=None, fid_list=None, field_layout=state['field_layout'])
+        constraint.pair_rows = state['pair_rows']
+        constraint.gap_masks = list()
+        worker_state['constraint'] = constraint
+        worker_state['messages_aligned_list'] = list()
+        worker_state['constraint_m_list'] = list()
+        worker_state['shm_list'] = list()
+        for shared_info in shared_info_list:
+            arrays = dict()
+            for key in ['messages', 'similarity', 'gap_mask']:
+                for name, info in shared_info[key].items():
+                    shm, arrays[name] = Constraint.attach_array(info)
+                    worker_state['shm_list'].append(shm)
+
+            messages = AlignedMessages(arrays['matrix'], arrays['indexes'], shared_info['ids'], arrays['direction'])
+            constraint_m = MessageSimilarity(messages=messages, engine=shared_info['engine'], eer_mode=shared_info['eer_mode'])
+            constraint_m.length = shared_info['length']
+            for name in shared_info['similarity']:
+                setattr(constraint_m, name, arrays[name])
+            worker_state['messages_aligned_list'].append(messages)
+            worker_state['constraint_m_list'].append(constraint_m)
+            constraint.gap_masks.append(arrays['gap_mask'])
+
+    @staticmethod
+    def compute_field_probabilities_worker(task):
+        direction, fid = task
+        constraint = worker_state['constraint']
+        return constraint.compute_field_probabilities(direction, fid, worker_state['messages_aligned_list'][direction], worker_state['constraint_m_list'][direction])
+
+    # copy the array into a new shared memory block
+    # output: the shared memory, (name, shape, dtype) to attach it
+    @staticmethod
+    def share_array(array):
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+        return shm, (shm.name, array.shape, array.dtype.str)
+
+    @staticmethod
+    def attach_array(info):
+        name, shape, dtype = info
+        shm = shared_memory.SharedMemory(name=name)
+        array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        array.flags.writeable = False
+        return shm, array
+
+    # the observation prob of each cluster: [pm,ps,pd,pv]
+    def compute_cluster_probabilities(self, symbols, constraint_m, gap_mask=None):
+        cluster_p = list()
+        cluster_p.append(constraint_m.compute_constraint_message_similarity(symbols))
+        cluster_p.append(self.compute_constraint_structure(symbols, gap_mask))
+        cluster_p.append(self.compute_constraint_dimension(symbols))
+        cluster_p.append(self.compute_constraint_value(symbols))
+
+        return cluster_p
 
     def save_observation_probabilities(self, pairs_p, pairs_size, direction):
         filename = "prob_request.txt" if direction == Constraint.TEST_TYPE_REQUEST else "prob_response.txt"
@@ -194,45 +386,48 @@ class Constraint:
 
     # compute p_s
     # TODO: provide another method to align each cluster again
-    def compute_constraint_structure(self, symbols):
+    # symbols: Partition (with its messages) or {name: Symbol}
+    # gap_mask: the gap mask of the partitioned messages, computed from the messages if it is not given
+    def compute_constraint_structure(self, symbols, gap_mask=None):
         logging.debug("[+] Compute observation probabilities of structure coherence")
-        sn_list = [str(s.name) for s in symbols.values()]
+        partition = self.get_partition(symbols)
+        if len(partition) == 0:
+            return list()
+        if gap_mask is None:
+            gap_mask = self.get_gap_mask(partition.messages)
+
+        # the num of gaps in each column of each cluster
+        gap_counts = np.add.reduceat(gap_mask[partition.order], partition.offsets[:-1], axis=0, dtype=np.int64)
+        # the num of gaps shared by all msgs of each cluster
+        num_gap_extra_list = (gap_counts == partition.sizes[:, np.newaxis]).sum(axis=1)
+        num_gap_total_list = gap_counts.sum(axis=1)
 
         # if there is ony one msg, then it is always 1.0
-        dict_result = dict() 
-        for s in symbols.values():
-            # compute the num of gaps shared by all msgs
-            num_gap_extra = 0
-            for i in range(len(s.messages[0].data)):
-                valuelist = [message.data[i] for message in s.messages]
-                if len(set(valuelist)) == 1 and valuelist[0] == '-':
-                    num_gap_extra += 1
-            #print("Num Extra Gaps: {}".format(num_gap_extra))
-            
-            # compute ave num of gaps
-            num_gap = 0 
-            for message in s.messages:
-                num_gap += (message.data.count("-") - num_gap_extra)
-
-            num_gap_ave = num_gap / len(s.messages)
-            percentage_gap = num_gap_ave / (len(s.messages[0].data) - num_gap_extra)
-            dict_result[s.name] = [1 - percentage_gap, num_gap_ave]
-
         p_s = list()
-        for s in sn_list:
-            p_s.append(dict_result[s][0])
+        length = gap_mask.shape[1]
+        for num_msgs, num_gap_extra, num_gap_total in zip(partition.sizes.tolist(), num_gap_extra_list.tolist(), num_gap_total_list.tolist()):
+            # compute ave num of gaps
+            num_gap = num_gap_total - num_msgs * num_gap_extra
+            num_gap_ave = num_gap / num_msgs
+            percentage_gap = num_gap_ave / (length - num_gap_extra)
+            p_s.append(1 - percentage_gap)
 
         return p_s
 
+    # aligned messages (with the same length) -> matrix of gaps
+    @staticmethod
+    def get_gap_mask(messages):
+        if isinstance(messages, AlignedMessages):
+            return messages.get_gap_mask()
+        return MessageSimilarity.encode_messages(messages) == AlignedMessages.GAP
+
     # compute p_d
     def compute_constraint_dimension(self, symbols):
         logging.debug("[+] Compute observation probabilities of dimension")
-        num_smallsymbols = 0
-        for s in symbols.values():
-            if len(s.messages) <= 2:
-                num_smallsymbols += 1
+        partition = self.get_partition(symbols)
+        num_smallsymbols = int((partition.sizes <= 2).sum())
 
-        p = 1 - num_smallsymbols / len(symbols.values())
+        p = 1 - num_smallsymbols / len(partition)
         p_d = [p]
 
         return p_d
@@ -240,7 +435,7 @@ class Constraint:
     # compute p_v
     def compute_constraint_value(self, symbols):
         # TODO: may not need it
-        if len(symbols.values()) == 1:
+        if len(self.get_partition(symbols)) == 1:
             p = -1
         else:
             p = 1
@@ -250,20 +445,22 @@ class Constraint:
 
     """ Processing Func
     """
+    def get_partition(self, symbols):
+        if isinstance(symbols, Partition):
+            return symbols
+        return Partition.from_symbols(symbols)
+
     # eliminate impossible fileds
-    def filter_fields(self, fields, fid_list, messages):
+    def filter_fields(self, fid_list, messages):
         logging.debug("[++++] Filter Fields")
         fid_list_new = list()
         for fid in fid_list:
             logging.debug("\n[+] Test Field_{0}".format(fid))
 
-            il, ir = 0, 0
-            for i in range(fid):
-                il += fields[i].domain.dataType.size[1] // 8
-            ir = il + (fields[fid].domain.dataType.size[1] // 8)
+            il, ir = self.field_layout.get_range(fid)
 
             # -1: the test field is too long
-            if (fields[fid].domain.dataType.size[1] // 8) > 10:
+            if self.field_layout.get_size(fid) > 10:
                 logging.debug("The tested field is too long.")
                 continue
 
@@ -276,9 +473,9 @@ class Constraint:
 
             #-3: too many symbols (>60%)
             # TODO
-            f_values = [message.data[il:ir] for message in messages]
-            percentage = len(messages) / len(set(f_values))
-            if percentage < 1.5 or len(set(f_values)) > 50: # TODO: save time, but may cause error in small data set (modbus_100)
+            num_values = len(Partition.by_columns(messages.matrix[:, il:ir]))
+            percentage = len(messages) / num_values
+            if percentage < 1.5 or num_values > 50: # TODO: save time, but may cause error in small data set (modbus_100)
                 logging.debug("There are too many symbols")
                 continue
 
@@ -287,84 +484,34 @@ class Constraint:
         #print(len(fid_list_new), fid_list_new)
         return fid_list_new
 
+    # all aligned messages have the same length
     def has_short_msg(self, messages, length):
-        for message in messages:
-            if len(message.data) <= length:
-                return True
-        return False
-
-    # merge other fields that are not tested in this run
-    def merge_nontest_fields(self, fields_origin, fid):
-        logging.debug("[+] Merge Fields")
-        fields_merged = list()
-        fields = copy.deepcopy(fields_origin)
-        fsize_total = 0
-        for i in range(len(fields)):
-            typename = fields[i].domain.dataType.typeName
-            if typename != "Raw":
-                logging.error("Field type is not Raw")
-            typesize = fields[i].domain.dataType.size[1]
-            # print(i, fid, typesize, type(typesize))
-
-            if i == fid:
-                if fsize_total > 0:
-                    field = Field(Raw(nbBytes=fsize_total//8))
-                    fields_merged.append(field)
-                    fsize_total = 0
-                if fid != (len(fields) - 1):    
-                    field = Field(Raw(nbBytes=typesize//8))
-                    fields_merged.append(field)
-                    field = Field()
-                    fields_merged.append(field)
-                else:
-                    if type(typesize).__name__ == 'NoneType':
-                        field = Field()
-                    else:
-                        field = Field(Raw(nbBytes=typesize//8))
-                    fields_merged.append(field)
-                break
-            else:
-                fsize_total += typesize         
+        return len(messages) > 0 and messages.length <= length
 
-        return fields_merged
-
-    def cluster_by_field(self, fields, messages, fid_merged):
+    # cluster the messages by their value of data[il:ir]
+    def cluster_by_field(self, messages, il, ir):
         logging.debug("[+] Generate Clusters")
-        if fid_merged == 0:
-            il = 0
-            ir = fields[0].domain.dataType.size[1] // 8
-        elif fid_merged == 1:
-            il =fields[0].domain.dataType.size[1] // 8
-            ir = il + (fields[1].domain.dataType.size[1] // 8)
-        else:
-            logging.error("Error: fid_merged should be 0 or 1")
-
-        f_values = [message.data[il:ir] for message in messages]
 
-        dict_fv_i = dict()
-        for i,fv in enumerate(f_values):
-            if fv not in dict_fv_i:
-                dict_fv_i[fv] = list()
-            dict_fv_i[fv].append(i)
+        # the field value of each message as a matrix of char codes
+        f_columns = messages.matrix[:, il:ir]
 
-        symbols = collections.OrderedDict()
-        for fv in dict_fv_i:
-            s = Symbol(name=fv, messages=[messages[i] for i in dict_fv_i[fv]])
-            symbols[fv] = s
+        # clusters are ordered by their first message, and named by their field value
+        symbols = Partition.by_columns(f_columns, messages=messages)
+        symbols.names = [f_columns[i].tobytes().decode('ascii') for i in symbols.get_first_members()]
 
         return symbols
 
     def change_symbol_name(self, symbols):
         logging.debug("[+] Change symbol names")
-        for keyFieldName, symbol in symbols.items():
+        for si, keyFieldName in enumerate(symbols.names):
             if type(keyFieldName).__name__ == "bytes":
                 keyFieldName = binascii.unhexlify(keyFieldName)
                 keyFieldName = keyFieldName.hex()
-                symbol.name = str(keyFieldName)
+                symbols.names[si] = str(keyFieldName)
             else:
-                symbol.name = keyFieldName
-            if len(symbol.name) > 40:
+                symbols.names[si] = keyFieldName
+            if len(symbols.names[si]) > 40:
                 md5 = hashlib.md5()
-                md5.update(symbol.name.encode('utf-8'))
-                symbol.name = str(md5.hexdigest())
+                md5.update(symbols.names[si].encode('utf-8'))
+                symbols.names[si] = str(md5.hexdigest())
         return symbols
@@ -15,15 +15,49 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>
 
 import logging
+import numpy as np
 
+from partition import Partition
+from aligned_messages import AlignedMessages
+
+"""
+engine: numpy (default), python
+numpy: compare the aligned messages as an integer matrix in blocks
+python: compare each pair of messages char by char
+
+eer_mode: histogram (default), sort
+histogram: compute eer from the score-count histograms of each cluster
+sort: compute eer from the sorted inner/inter scores of each cluster
+"""
 class MessageSimilarity:
+    ENGINE_NUMPY = "numpy"
+    ENGINE_PYTHON = "python"
+    EER_HISTOGRAM = "histogram"
+    EER_SORT = "sort"
+    BLOCK_SIZE = 4096 # number of columns encoded at once
 
-    def __init__(self, messages):
+    def __init__(self, messages, engine=ENGINE_NUMPY, eer_mode=EER_HISTOGRAM):
         self.messages = messages
+        self.engine = engine
+        self.eer_mode = eer_mode
         self.similarity_matrix = list()
+        self.match_matrix = None # num of matched chars of each pair (only for aligned messages)
+        self.score_histograms = None # the score-count histogram of each message
+        self.length = 0
+
+        assert self.engine in [MessageSimilarity.ENGINE_NUMPY, MessageSimilarity.ENGINE_PYTHON], "the engine should be numpy or python"
+        assert self.eer_mode in [MessageSimilarity.EER_HISTOGRAM, MessageSimilarity.EER_SORT], "the eer_mode should be histogram or sort"
 
     def compute_similarity_matrix(self):
         print("[++++] Compute matrix of similarity scores")
+        if self.engine == MessageSimilarity.ENGINE_NUMPY:
+            if isinstance(self.messages, AlignedMessages) or len(set(len(message.data) for message in self.messages)) <= 1:
+                self.compute_similarity_matrix_numpy()
+                return
+            logging.error("The aligned messages don't have same length. Use the python engine instead.")
+        self.compute_similarity_matrix_python()
+
+    def compute_similarity_matrix_python(self):
         scoreslist = list()
         for i in range(len(self.messages)):
             initial_scores_list = [-1 for i in range(len(self.messages))]
@@ -40,7 +74,46 @@ class MessageSimilarity:
                     scoreslist[i][j] = score
                     scoreslist[j][i] = score 
         
-        self.similarity_matrix = scoreslist
+        self.similarity_matrix = np.array(scoreslist)
+
+        # the scores are matches / length, so the num of matches can be recovered
+        if len(self.messages) > 0 and len(set(len(message.data) for message in self.messages)) == 1:
+            self.length = len(self.messages[0].data)
+            self.match_matrix = np.rint(self.similarity_matrix * self.length).astype(np.int32)
+            np.fill_diagonal(self.match_matrix, self.length)
+
+    # the same scores as compute_similarity_scores_by_alignment for all pairs
+    # matches of each pair are counted with one matrix product per symbol and column block
+    def compute_similarity_matrix_numpy(self):
+        msgs_matrix = self.encode_messages(self.messages)
+        num_msgs, length = msgs_matrix.shape
+
+        matches = np.zeros((num_msgs, num_msgs), dtype=np.float32)
+        for il in range(0, length, MessageSimilarity.BLOCK_SIZE):
+            block = msgs_matrix[:, il:il+MessageSimilarity.BLOCK_SIZE]
+            for symbol in np.unique(block):
+                onehot = (block == symbol).astype(np.float32)
+                matches += onehot @ onehot.T
+        self.match_matrix = np.rint(matches).astype(np.int32)
+        self.length = length
+
+        if length > 0:
+            self.similarity_matrix = self.match_matrix / length
+        else:
+            self.similarity_matrix = np.zeros((num_msgs, num_msgs))
+        np.fill_diagonal(self.similarity_matrix, 100.0)
+
+    # aligned messages (with the same length) -> matrix of char codes
+    @staticmethod
+    def encode_messages(messages):
+        if isinstance(messages, AlignedMessages):
+            return messages.matrix
+        if len(messages) == 0:
+            return np.zeros((0, 0), dtype=np.uint8)
+        msgs_data = ''.join(message.data for message in messages)
+        msgs_matrix = np.frombuffer(msgs_data.encode('ascii'), dtype=np.uint8)
+
+        return msgs_matrix.reshape(len(messages), -1)
         
     def compute_similarity_scores_by_alignment(self, msgdata1, msgdata2):
         if len(msgdata1) != len(msgdata2):
@@ -52,12 +125,18 @@ class MessageSimilarity:
         return score
 
     # compute p_m
+    # symbols: Partition of self.messages, or {name: Symbol}
     def compute_constraint_message_similarity(self, symbols):
         logging.debug("[+] Compute observation probabilities of message similarity")
-        sn_list = [str(s.name) for s in symbols.values()]
+        partition = self.get_partition(symbols)
+        sn_list = partition.names
 
-        inner_inter_scores = self.compute_inner_inter_scores(symbols)
-        symbol_m = self.compute_similarity_constraints(inner_inter_scores)
+        if self.eer_mode == MessageSimilarity.EER_HISTOGRAM and self.match_matrix is not None:
+            inner_inter_histograms = self.compute_inner_inter_histograms(partition)
+            symbol_m = self.compute_similarity_constraints_by_histogram(inner_inter_histograms)
+        else:
+            inner_inter_scores = self.compute_inner_inter_scores(partition)
+            symbol_m = self.compute_similarity_constraints(inner_inter_scores)
 
         p_m = list()
         for s in sn_list:
@@ -71,43 +150,86 @@ class MessageSimilarity:
 
         return p_m
 
+    def get_partition(self, symbols):
+        if isinstance(symbols, Partition):
+            return symbols
+        return Partition.from_symbols(symbols, self.messages)
+
     # compute Inner/Inter scores
-    # inner_inter_scores: {symbol_name: [num of msgs, inner scores, inter scores]}
-    def compute_inner_inter_scores(self, symbols):
+    # inner_inter_scores: {symbol_name: [message indexes, inner scores, inter scores]}
+    # the scores are only sorted (descending) if sort_scores is set
+    def compute_inner_inter_scores(self, symbols, sort_scores=False):
         logging.debug("[+] Compute Inner/Inter Scores")
+        partition = self.get_partition(symbols)
 
-        dict_mid_i = dict()
-        for i,message in enumerate(self.messages):
-            dict_mid_i[message.id] = i
+        # membership vector: the symbol index of each message
+        labels = partition.labels
+        similarity_matrix = np.asarray(self.similarity_matrix)
 
         inner_inter_scores = dict()
 
-        for s in symbols.values():
-            sn = str(s.name)
+        for si, sn in enumerate(partition.names):
 
-            #0: message num
-            #1: inner scores list
-            #2: inter scores list
+            #0: message indexes
+            #1: inner scores
+            #2: inter scores
             inner_inter_scores[sn] = list()
-            # TODO: message num is not used
-            
-            mi_list = [dict_mid_i[message.id] for message in s.messages]
-            inner_inter_scores[sn].append(mi_list) #0: message num
-            
-            inner_score_list, inter_score_list = list(), list()
-            for i in range(len(mi_list)):
-                for j in range(i + 1, len(mi_list)):
-                    inner_score_list.append(self.similarity_matrix[mi_list[i]][mi_list[j]])
-            for i in mi_list:
-                for j in range(len(self.messages)):
-                    if j not in mi_list:
-                        inter_score_list.append(self.similarity_matrix[i][j])
-            
-            inner_inter_scores[sn].append(sorted(inner_score_list, reverse=True))
-            inner_inter_scores[sn].append(sorted(inter_score_list, reverse=True))
+
+            mask = labels == si
+            mi_array = partition.get_members(si)
+            inner_inter_scores[sn].append(mi_array.tolist()) #0: message indexes
+
+            scores_inner = similarity_matrix[np.ix_(mi_array, mi_array)]
+            inner_scores = scores_inner[np.triu_indices(len(mi_array), k=1)]
+            inter_scores = similarity_matrix[np.ix_(mi_array, np.flatnonzero(~mask))].ravel()
+
+            if sort_scores:
+                inner_scores = np.sort(inner_scores)[::-1].tolist()
+                inter_scores = np.sort(inter_scores)[::-1].tolist()
+            inner_inter_scores[sn].append(inner_scores)
+            inner_inter_scores[sn].append(inter_scores)
             
         return inner_inter_scores
 
+    # score-count histogram of each message: [i][k] = num of messages that have k matches with message i
+    # (including message i itself)
+    def compute_score_histograms(self):
+        num_msgs = len(self.messages)
+        num_bins = self.length + 1
+        self.score_histograms = np.zeros((num_msgs, num_bins), dtype=np.int32)
+
+        block_size = max(1, MessageSimilarity.BLOCK_SIZE * 256 // max(num_msgs, 1))
+        for il in range(0, num_msgs, block_size):
+            block = self.match_matrix[il:il+block_size]
+            bins = block + (np.arange(len(block)) * num_bins)[:, np.newaxis]
+            histograms = np.bincount(bins.ravel(), minlength=len(block) * num_bins)
+            self.score_histograms[il:il+block_size] = histograms.reshape(len(block), num_bins)
+
+    # compute Inner/Inter histograms
+    # inner_inter_histograms: {symbol_name: [message indexes, inner histogram, inter histogram]}
+    # histogram[k]: num of message pairs whose score is k / length
+    def compute_inner_inter_histograms(self, symbols):
+        logging.debug("[+] Compute Inner/Inter Histograms")
+        if self.score_histograms is None:
+            self.compute_score_histograms()
+        partition = self.get_partition(symbols)
+
+        inner_inter_histograms = dict()
+        for si, sn in enumerate(partition.names):
+            mi_array = partition.get_members(si)
+
+            # all ordered pairs inside the cluster, including (i, i)
+            histogram_cluster = np.bincount(self.match_matrix[np.ix_(mi_array, mi_array)].ravel(), minlength=self.length + 1)
+            histogram_all = self.score_histograms[mi_array].sum(axis=0, dtype=np.int64)
+
+            inter_histogram = histogram_all - histogram_cluster
+            histogram_cluster[self.length] -= len(mi_array)
+            inner_histogram = histogram_cluster // 2
+
+            inner_inter_histograms[sn] = [mi_array.tolist(), inner_histogram, inter_histogram]
+
+        return inner_inter_histograms
+
     # compute similarity constraints of each cluster
     # symbol_m: {symbol_name: list of p_m}
     def compute_similarity_constraints(self, inner_inter_scores):
@@ -116,6 +238,12 @@ class MessageSimilarity:
             symbol_m[key] = 1 - self.compute_eer(values[1], values[2])
         return symbol_m
 
+    def compute_similarity_constraints_by_histogram(self, inner_inter_histograms):
+        symbol_m = {}
+        for key,values in inner_inter_histograms.items():
+            symbol_m[key] = 1 - self.compute_eer_by_histogram(values[1], values[2])
+        return symbol_m
+
     # compute eer
     def compute_eer(self, inner_scores, inter_scores):
         #tfnmr = stat_scores(inner_score_list)
@@ -126,6 +254,19 @@ class MessageSimilarity:
         t_fnmr_list = self.compute_fnmrs(inner_scores)
         t_fmr_list = self.compute_fmrs(inter_scores)
 
+        return self.compute_eer_by_rates(t_fnmr_list, t_fmr_list)
+
+    # the same as compute_eer, but the scores are given as histograms
+    def compute_eer_by_histogram(self, inner_histogram, inter_histogram):
+        if inner_histogram.sum() == 0 or inter_histogram.sum() == 0:
+            return 1 # 0.05
+
+        t_fnmr_list = self.compute_fnmrs_by_histogram(inner_histogram)
+        t_fmr_list = self.compute_fmrs_by_histogram(inter_histogram)
+
+        return self.compute_eer_by_rates(t_fnmr_list, t_fmr_list)
+
+    def compute_eer_by_rates(self, t_fnmr_list, t_fmr_list):
         tfnmrlist = [x[0] for x in t_fnmr_list]
         fnmrlist = [x[1] for x in t_fnmr_list]
         tfmrlist = [x[0] for x in t_fmr_list]
@@ -189,7 +330,7 @@ class MessageSimilarity:
     # ouput: list of [t, fnmr]
     # when computing fnmr, only consider scores > t (not >= t)
     def compute_fnmrs(self, scores):
-        scores.sort()
+        scores = np.sort(scores).tolist()
         numGM = len(scores)
         t_fnmr_list = list()
 
@@ -217,7 +358,7 @@ class MessageSimilarity:
     # output: list of [t, fmr]
     # when computing fmr, only consider scores > t
     def compute_fmrs(self, scores):
-        scores.sort()
+        scores = np.sort(scores).tolist()
         numIM = len(scores)
         t_fmr_list = list()
 
@@ -241,3 +382,31 @@ class MessageSimilarity:
         t_fmr_list.append(result)
 
         return t_fmr_list
+
+    # the same output as compute_fnmrs: [0, 0], [t, fnmr] of each score t, [1, 1]
+    def compute_fnmrs_by_histogram(self, histogram):
+        scores = np.flatnonzero(histogram).tolist()
+        counts = np.cumsum(histogram[scores]).tolist()
+        numGM = counts[-1]
+
+        t_fnmr_list = [[0, 0]]
+        for score, count in zip(scores[:-1], counts[:-1]):
+            t_fnmr_list.append([score / self.length, count / numGM])
+        t_fnmr_list.append([scores[-1] / self.length, 1])
+        t_fnmr_list.append([1, 1])
+
+        return t_fnmr_list
+
+    # the same output as compute_fmrs: [0, 1], [t, fmr] of each score t, [1, 0]
+    def compute_fmrs_by_histogram(self, histogram):
+        scores = np.flatnonzero(histogram).tolist()
+        counts = np.cumsum(histogram[scores]).tolist()
+        numIM = counts[-1]
+
+        t_fmr_list = [[0, 1]]
+        for score, count in zip(scores[:-1], counts[:-1]):
+            t_fmr_list.append([score / self.length, (numIM - count) / numIM])
+        t_fmr_list.append([scores[-1] / self.length, 0])
+        t_fmr_list.append([1, 0])
+
+        return t_fmr_list
@@ -14,21 +14,71 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>
 
+import numpy as np
 from pgmpy.models import FactorGraph
 from pgmpy.factors.discrete import DiscreteFactor
 from pgmpy.inference import BeliefPropagation
 
+"""
+backend: analytic (default), pgmpy
+analytic: the graph is a star around k, so compute the marginal of k as the product of the messages from each leaf (in log space)
+pgmpy: build the factor graph and run BeliefPropagation
+"""
 class MyFactorGraph:
+    BACKEND_ANALYTIC = "analytic"
+    BACKEND_PGMPY = "pgmpy"
 
-    def __init__(self, p_observation, p_implication):
+    def __init__(self, p_observation, p_implication, backend=BACKEND_ANALYTIC):
         self.p_observation = p_observation
         self.p_implication = p_implication
+        self.backend = backend
+
+        assert self.backend in [MyFactorGraph.BACKEND_ANALYTIC, MyFactorGraph.BACKEND_PGMPY], "the backend should be analytic or pgmpy"
 
     # Compute Pk
     # type_list: 0: k2x & x2k, 1: k2x, 2: x2k, -1: not test
     def compute_pk(self, type_list, fid):
         assert len(type_list) == 5, print("ComputePk Error: number of type_list should be 5")
 
+        if self.backend == MyFactorGraph.BACKEND_ANALYTIC:
+            return self.compute_pk_analytic(type_list, fid)
+        return self.compute_pk_pgmpy(type_list, fid)
+
+    # the same marginal as compute_pk_pgmpy
+    def compute_pk_analytic(self, type_list, fid):
+        log_pk = np.zeros(2)
+        for i in range(len(type_list)):
+            if type_list[i] not in [0, 1, 2]:
+                continue
+            p_ktox = self.p_implication[fid][0][i] if type_list[i] in [0, 1] else None
+            p_xtok = self.p_implication[fid][1][i] if type_list[i] in [0, 2] else None
+            leaf_k0, leaf_k1 = MyFactorGraph.compute_leaf_messages(self.p_observation[fid][i], p_ktox, p_xtok)
+            with np.errstate(divide='ignore'):
+                log_pk += [np.sum(np.log(leaf_k0)), np.sum(np.log(leaf_k1))]
+
+        return MyFactorGraph.normalize_log_pk(log_pk[0], log_pk[1])
+
+    # the message from each leaf x to k: sum_x phi1(x) * phi2(k, x) * phi3(k, x), for k = 0 and k = 1
+    # phi2 (k -> x) and phi3 (x -> k) are skipped if p_ktox/p_xtok is None
+    @staticmethod
+    def compute_leaf_messages(p_x, p_ktox=None, p_xtok=None):
+        p1 = np.asarray(p_x, dtype=np.float64)
+        p2 = np.ones_like(p1) if p_ktox is None else np.asarray(p_ktox, dtype=np.float64)
+        p3 = np.ones_like(p1) if p_xtok is None else np.asarray(p_xtok, dtype=np.float64)
+        phi2_k1x0 = 1 - p2 if p_ktox is not None else p2
+        phi3_k0x1 = 1 - p3 if p_xtok is not None else p3
+
+        leaf_k0 = (1 - p1) * p2 * p3 + p1 * p2 * phi3_k0x1
+        leaf_k1 = (1 - p1) * phi2_k1x0 * p3 + p1 * p2 * p3
+
+        return leaf_k0, leaf_k1
+
+    # log P(k=0), log P(k=1) (unnormalized) -> P(k=1)
+    @staticmethod
+    def normalize_log_pk(log_pk0, log_pk1):
+        return np.exp(log_pk1 - np.logaddexp(log_pk0, log_pk1))
+
+    def compute_pk_pgmpy(self, type_list, fid):
         constraint_name = ['m', 'r', 's', 'd', 'v']
         '''
         m, r, s, d, v = type_list
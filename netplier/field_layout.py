@@ -0,0 +1,78 @@
+# This file is part of NetPlier, a tool for binary protocol reverse engineering.
+# Copyright (C) 2021 Yapeng Ye
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>
+
+import os
+import logging
+import numpy as np
+
+"""
+Layout of the fields of the aligned messages, computed once and shared by the constraints and the clustering
+sizes: the size of each field in the aligned messages (the max size in msa_fields_info, in chars)
+offsets: field i is data[offsets[i]:offsets[i+1]] of each aligned message (prefix sums of sizes)
+sizes_min: the min size of each field (in chars)
+typenames: the netzob type of each field
+fieldtypes: the type of each field in msa_fields_info (D: dynamic, S: static)
+"""
+class FieldLayout:
+    FIELDTYPE_DYNAMIC = 'D'
+
+    def __init__(self, sizes, sizes_min=None, typenames=None, fieldtypes=None):
+        self.sizes = np.array(sizes, dtype=np.int64)
+        self.sizes_min = np.array(sizes_min, dtype=np.int64) if sizes_min is not None else self.sizes.copy()
+        self.offsets = np.concatenate(([0], np.cumsum(self.sizes))).astype(np.int64)
+        self.typenames = list(typenames) if typenames is not None else ["Raw" for i in range(len(self.sizes))]
+        self.fieldtypes = list(fieldtypes) if fieldtypes is not None else [FieldLayout.FIELDTYPE_DYNAMIC for i in range(len(self.sizes))]
+
+    def __len__(self):
+        return len(self.sizes)
+
+    # the range [il, ir) of field fid in the aligned messages
+    def get_range(self, fid):
+        return int(self.offsets[fid]), int(self.offsets[fid + 1])
+
+    def get_size(self, fid):
+        return int(self.sizes[fid])
+
+    # fids of the dynamic fields (the keyword candidates)
+    def get_candidates(self):
+        return [fid for fid, fieldtype in enumerate(self.fieldtypes) if fieldtype == FieldLayout.FIELDTYPE_DYNAMIC]
+
+    # each line of msa_fields_info: typename typesizemin typesizemax fieldtype (sizes in bits)
+    @staticmethod
+    def from_fieldsinfo(filepath_fields_info):
+        assert os.path.isfile(filepath_fields_info), "The fields info file doesn't exist"
+
+        typenames, sizes_min, sizes, fieldtypes = list(), list(), list(), list()
+        with open(filepath_fields_info) as f:
+            for line in f.read().splitlines():
+                typename, typesizemin, typesizemax, fieldtype = line.split()
+                if typename != "Raw":
+                    logging.error("Field type is not Raw")
+                typenames.append(typename)
+                sizes_min.append(int(typesizemin) // 8)
+                sizes.append(int(typesizemax) // 8)
+                fieldtypes.append(fieldtype)
+
+        return FieldLayout(sizes, sizes_min, typenames, fieldtypes)
+
+    # netzob fields -> FieldLayout
+    @staticmethod
+    def from_fields(fields):
+        sizes = [field.domain.dataType.size[1] // 8 for field in fields]
+        sizes_min = [field.domain.dataType.size[0] // 8 for field in fields]
+        typenames = [field.domain.dataType.typeName for field in fields]
+
+        return FieldLayout(sizes, sizes_min, typenames)
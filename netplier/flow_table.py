@@ -0,0 +1,67 @@
+# This file is part of NetPlier, a tool for binary protocol reverse engineering.
+# Copyright (C) 2021 Yapeng Ye
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>
+
+import logging
+import numpy as np
+
+"""
+Flow table of a trace: the messages between the same two endpoints are a session (as the true sessions of netzob)
+built once when the messages are imported, and shared by the direction inference, the dataset info and the constraints
+session_ids: the session id of each message (sessions are numbered by their first message in date order)
+order/offsets: the message indexes of session i (sorted by date) are order[offsets[i]:offsets[i+1]]
+sides: 0 if the source of a message is the first endpoint of its session (the normalized pair), otherwise 1
+endpoints: the normalized endpoint pair of each session
+"""
+class FlowTable:
+
+    def __init__(self, messages):
+        dates = np.array([message.date if message.date is not None else 0 for message in messages], dtype=np.float64)
+        messages_order = np.argsort(dates, kind='stable')
+
+        dict_endpoints_sid = dict()
+        self.endpoints = list()
+        self.session_ids = np.empty(len(messages), dtype=np.int64)
+        self.sides = np.empty(len(messages), dtype=np.int8)
+        for i in messages_order.tolist():
+            source, destination = messages[i].source, messages[i].destination
+            # the key of a session is the same for both directions
+            endpoints = (source, destination) if source <= destination else (destination, source)
+            sid = dict_endpoints_sid.get(endpoints)
+            if sid is None:
+                sid = len(self.endpoints)
+                dict_endpoints_sid[endpoints] = sid
+                self.endpoints.append(endpoints)
+            self.session_ids[i] = sid
+            self.sides[i] = 0 if source == endpoints[0] else 1
+
+        # the messages of each session, in date order
+        self.order = messages_order[np.argsort(self.session_ids[messages_order], kind='stable')]
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(self.session_ids, minlength=len(self.endpoints))))).astype(np.int64)
+        logging.debug("Number of sessions: {0}".format(self.get_num_sessions()))
+
+    def get_num_sessions(self):
+        return len(self.endpoints)
+
+    # the message indexes of each session (sorted by date)
+    def get_sessions(self):
+        for i in range(self.get_num_sessions()):
+            yield self.order[self.offsets[i]:self.offsets[i+1]]
+
+    # the direction of each message: the msgs from the source of the first msg of its session are requests (0), the others are responses (1)
+    def get_directions(self):
+        sides_first = self.sides[self.order[self.offsets[:-1]]]
+
+        return (self.sides != sides_first[self.session_ids]).astype(np.int64)
@@ -23,7 +23,6 @@ logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 
 from netplier import NetPlier
 from processing import Processing
-from alignment import Alignment
 from clustering import Clustering
 
 if __name__ == '__main__':
@@ -32,29 +31,37 @@ if __name__ == '__main__':
 
     parser.add_argument('-i', '--input', required=True, dest='filepath_input', help='filepath of input trace')
     parser.add_argument('-t', '--type', dest='protocol_type', help='type of the protocol (for generating the ground truth): \
-        dhcp, dnp3, icmp, modbus, ntp, smb, smb2, tftp, zeroaccess')
+        dhcp, dnp3, ftp, icmp, modbus, ntp, smb, smb2, tftp, zeroaccess')
     parser.add_argument('-o', '--output_dir', dest='output_dir', default='tmp_netplier/', help='output directory')
     parser.add_argument('-l', '--layer', dest='layer', default=5, type=int, help='the layer of the protocol')
     parser.add_argument('-m', '--mafft', dest='mafft_mode', default='ginsi', help='the mode of mafft: [ginsi, linsi, einsi]')
     parser.add_argument('-mt', '--multithread', dest='multithread', default=False, action='store_true', help='run mafft with multi threads')
+    parser.add_argument('-sa', '--sample_add', dest='num_seeds', default=0, type=int, help='align a sample of N messages with mafft, then add the others to it (default: 0, align all messages)')
+    parser.add_argument('-pa', '--partitions', dest='num_partitions', default=0, type=int, help='align N length bands of the messages concurrently with mafft, then merge them (default: 0, align all messages)')
+    parser.add_argument('-e', '--encoding', dest='encoding', default='hex', choices=['hex', 'byte'], help='the encoding of the messages for mafft: [hex, byte]')
+    parser.add_argument('-u', '--uniform', dest='num_lengths_uniform', default=0, type=int, help='skip mafft if the messages have at most N different lengths (default: 0, always run mafft)')
+    parser.add_argument('-c', '--cache', dest='cache_dir', default=None, help='the folder to cache the alignment results of the same messages and options (default: no cache)')
+    parser.add_argument('-cs', '--cache_size', dest='cache_size', default=1024, type=int, help='the max size of the alignment cache in MB (default: 1024)')
+    parser.add_argument('-d', '--dedup', dest='dedup', default=False, action='store_true', help='align each unique payload once, then copy its alignment to all messages with this payload')
+    parser.add_argument('-r', '--reader', dest='reader', default='netzob', choices=['netzob', 'native'], help='the reader of the input trace: [netzob, native]')
+    parser.add_argument('-w', '--workers', dest='num_workers', default=1, type=int, help='the number of processes used to test the candidate fields')
 
     args = parser.parse_args()
 
-    p = Processing(filepath=args.filepath_input, protocol_type=args.protocol_type, layer=args.layer)
+    p = Processing(filepath=args.filepath_input, protocol_type=args.protocol_type, layer=args.layer, reader=args.reader)
     # p.print_dataset_info()
     
     mode = args.mafft_mode
     if args.protocol_type in['dnp3']: # tftp
         mode = 'linsi'
-    netplier = NetPlier(messages=p.messages, direction_list=p.direction_list, output_dir=args.output_dir, mode=mode, multithread=args.multithread)
+    netplier = NetPlier(messages=p.messages, direction_list=p.direction_list, output_dir=args.output_dir, mode=mode, multithread=args.multithread, num_workers=args.num_workers, flow_table=p.flow_table, num_seeds=args.num_seeds, num_partitions=args.num_partitions, encoding=args.encoding, num_lengths_uniform=args.num_lengths_uniform, cache_dir=args.cache_dir, cache_size=args.cache_size * 1024 * 1024, dedup=args.dedup)
     fid_inferred = netplier.execute()
     
     # Clustering
-    messages_aligned = Alignment.get_messages_aligned(netplier.messages, os.path.join(netplier.output_dir, Alignment.FILENAME_OUTPUT_ONELINE))
     messages_request, messages_response = Processing.divide_msgs_by_directionlist(netplier.messages, netplier.direction_list)
-    messages_request_aligned, messages_response_aligned = Processing.divide_msgs_by_directionlist(messages_aligned, netplier.direction_list)
+    messages_request_aligned, messages_response_aligned = netplier.messages_aligned.get_requests(), netplier.messages_aligned.get_responses()
 
-    clustering = Clustering(fields=netplier.fields, protocol_type=args.protocol_type)
+    clustering = Clustering(fields=netplier.fields, protocol_type=args.protocol_type, field_layout=netplier.field_layout)
     clustering_result_request_true = clustering.cluster_by_kw_true(messages_request)
     clustering_result_response_true = clustering.cluster_by_kw_true(messages_response)
     clustering_result_request_netplier = clustering.cluster_by_kw_inferred(fid_inferred, messages_request_aligned)
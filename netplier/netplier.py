@@ -24,16 +24,32 @@ from netzob.Model.Vocabulary.Types.Raw import Raw
 #from netzob.Model.Vocabulary.Field import Field
 
 from alignment import Alignment
+from alignment_cache import AlignmentCache
+from field_layout import FieldLayout
+from session_index import SessionIndex
 from constraint.constraint import Constraint
 from probabilistic_inference import ProbabilisticInference
 
 class NetPlier:
-    def __init__(self, messages, direction_list=None, output_dir='tmp/', mode='ginsi', multithread=False):
+    def __init__(self, messages, direction_list=None, output_dir='tmp/', mode='ginsi', multithread=False, num_workers=1, flow_table=None, num_seeds=0, num_partitions=0, encoding=Alignment.ENCODING_HEX, num_lengths_uniform=0, cache_dir=None, cache_size=AlignmentCache.MAX_SIZE, dedup=False):
         self.messages = messages
         self.direction_list = direction_list
+        self.flow_table = flow_table
         self.output_dir = output_dir
         self.mode = mode
         self.multithread = multithread
+        self.num_workers = num_workers
+        self.num_seeds = num_seeds
+        self.num_partitions = num_partitions
+        self.encoding = encoding
+        self.num_lengths_uniform = num_lengths_uniform
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.dedup = dedup
+        self.fields = None
+        self.field_layout = None
+        self.session_index = None
+        self.messages_aligned = None
 
         if not os.path.exists(self.output_dir):
             logging.debug("Folder {0} doesn't exist".format(self.output_dir))
@@ -43,10 +59,14 @@ class NetPlier:
         
         # Alignment
         # TODO: choose mode automatically
-        msa = Alignment(messages=self.messages, output_dir=self.output_dir, mode=self.mode, multithread=self.multithread)
+        msa = Alignment(messages=self.messages, output_dir=self.output_dir, mode=self.mode, multithread=self.multithread, num_seeds=self.num_seeds, num_partitions=self.num_partitions, encoding=self.encoding, num_lengths_uniform=self.num_lengths_uniform, cache_dir=self.cache_dir, cache_size=self.cache_size, dedup=self.dedup)
         #msa = Alignment(messages=self.messages, output_dir=self.output_dir, multithread=True)
         msa.execute()
         # exit()
+
+        # the sessions and the aligned messages are shared by all stages
+        self.session_index = SessionIndex(self.messages, self.direction_list, self.flow_table)
+        self.messages_aligned = msa.get_aligned_messages(self.direction_list, self.session_index)
         
         # Generate fields
         filepath_fields_info = os.path.join(self.output_dir, Alignment.FILENAME_FIELDS_INFO)
@@ -54,9 +74,11 @@ class NetPlier:
         logging.debug("Number of keyword candidates: {}\nfid: {}".format(len(fid_list), fid_list))
         
         # Compute probabilities of observation constraints
-        constraint = Constraint(messages=self.messages, direction_list=self.direction_list, fields=self.fields, fid_list=fid_list, output_dir=self.output_dir)
+        constraint = Constraint(messages=self.messages, direction_list=self.direction_list, fields=self.fields, fid_list=fid_list, output_dir=self.output_dir, num_workers=self.num_workers, \
+            field_layout=self.field_layout, session_index=self.session_index, messages_aligned=self.messages_aligned)
         
-        pairs_p, pairs_size = constraint.compute_observation_probabilities()
+        # only the same fid for both sides is inferred, so the remote coupling of the other pairs is not computed
+        pairs_p, pairs_size = constraint.compute_observation_probabilities(pairs=Constraint.PAIRS_DIAGONAL)
         pairs_p_request, pairs_p_response = pairs_p
         pairs_size_request, pairs_size_response = pairs_size
         constraint.save_observation_probabilities(pairs_p_request, pairs_size_request, Constraint.TEST_TYPE_REQUEST)
@@ -71,7 +93,8 @@ class NetPlier:
         pairs_p_all, pairs_size_all = self.merge_constraint_results(pairs_p_request, pairs_p_response, pairs_size_request, pairs_size_response)
 
         ffid_list = ["{0}-{0}".format(fid) for fid in fid_list] #only test same fid for both sides
-        pi = ProbabilisticInference(pairs_p=pairs_p_request, pairs_size=pairs_size_request)
+        # the probs are normalized in the same range as all pairs
+        pi = ProbabilisticInference(pairs_p=pairs_p_request, pairs_size=pairs_size_request, pairs_range=constraint.pairs_range[Constraint.TEST_TYPE_REQUEST])
         fid_inferred = pi.execute(ffid_list)
         
         ## TODO: iterative
@@ -99,6 +122,8 @@ class NetPlier:
 
         fields = self.generate_fields(fields_result)
         logging.debug("Number of fields: {0}".format(len(fields)))
+        # offsets/sizes of the fields, shared by the constraints and the clustering
+        self.field_layout = FieldLayout.from_fieldsinfo(filepath_fields_info)
 
         return fields, fid_list
 
@@ -0,0 +1,84 @@
+# This file is part of NetPlier, a tool for binary protocol reverse engineering.
+# Copyright (C) 2021 Yapeng Ye
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>
+
+import numpy as np
+
+"""
+Partition of a list of messages into clusters, a light replacement of the dict of netzob Symbols
+labels: the cluster index of each message (clusters are ordered by their first message)
+order/offsets: the message indexes of cluster i are order[offsets[i]:offsets[i+1]] (in message order)
+sizes: the num of messages of each cluster
+names: the name of each cluster
+messages: the partitioned messages (optional)
+"""
+class Partition:
+
+    def __init__(self, labels, names=None, messages=None):
+        self.labels = np.asarray(labels, dtype=np.int64)
+        num_clusters = int(self.labels.max()) + 1 if len(self.labels) > 0 else 0
+        assert len(self.labels) == 0 or self.labels.min() >= 0, "every message should be in a cluster"
+
+        self.sizes = np.bincount(self.labels, minlength=num_clusters)
+        self.offsets = np.concatenate(([0], np.cumsum(self.sizes))).astype(np.int64)
+        self.order = np.argsort(self.labels, kind='stable')
+        self.names = list(names) if names is not None else [str(i) for i in range(num_clusters)]
+        self.messages = messages
+        assert len(self.names) == num_clusters, "the num of names should be the num of clusters"
+
+    def __len__(self):
+        return len(self.names)
+
+    # the message indexes of cluster i
+    def get_members(self, i):
+        return self.order[self.offsets[i]:self.offsets[i+1]]
+
+    # the index of the first message of each cluster
+    def get_first_members(self):
+        return self.order[self.offsets[:-1]]
+
+    # cluster the rows of a (num of messages x width) matrix by their values
+    @staticmethod
+    def by_columns(columns, messages=None):
+        columns = np.asarray(columns)
+        if columns.shape[0] == 0:
+            return Partition(np.zeros(0, dtype=np.int64), messages=messages)
+        if columns.shape[1] == 0:
+            return Partition(np.zeros(columns.shape[0], dtype=np.int64), messages=messages)
+
+        _, first, inverse = np.unique(columns, axis=0, return_index=True, return_inverse=True)
+        # np.unique sorts the values, reorder the clusters by their first message
+        rank = np.empty(len(first), dtype=np.int64)
+        rank[np.argsort(first, kind='stable')] = np.arange(len(first))
+
+        return Partition(rank[inverse.reshape(-1)], messages=messages)
+
+    # {name: Symbol} -> Partition
+    # the labels follow the order of messages if it is given, otherwise the order of the symbols
+    @staticmethod
+    def from_symbols(symbols, messages=None):
+        names = [str(s.name) for s in symbols.values()]
+        if messages is None:
+            messages = [message for s in symbols.values() for message in s.messages]
+
+        dict_mid_i = dict()
+        for i,message in enumerate(messages):
+            dict_mid_i[message.id] = i
+
+        labels = np.full(len(messages), -1, dtype=np.int64)
+        for si, s in enumerate(symbols.values()):
+            labels[[dict_mid_i[message.id] for message in s.messages]] = si
+
+        return Partition(labels, names=names, messages=messages)
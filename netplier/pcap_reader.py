@@ -0,0 +1,327 @@
+# This file is part of NetPlier, a tool for binary protocol reverse engineering.
+# Copyright (C) 2021 Yapeng Ye
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>
+
+import mmap
+import socket
+import struct
+import logging
+
+"""
+A streaming reader of pcap/pcapng files, the file is memory-mapped and the payloads are memoryviews of it
+layer: the data of each record starts at the header of this layer (the same as the importLayer of netzob)
+  2: the link layer frame
+  3: the network layer packet (IPv4/IPv6)
+  4: the transport layer segment (TCP/UDP)
+  5: the transport layer payload (records with empty payloads are skipped)
+link types: Ethernet (with VLAN tags), Linux cooked capture (v1/v2), raw IP, BSD loopback
+"""
+class PcapReader:
+    LINKTYPE_NULL = 0
+    LINKTYPE_ETHERNET = 1
+    LINKTYPE_RAW = 101
+    LINKTYPE_LOOP = 108
+    LINKTYPE_LINUX_SLL = 113
+    LINKTYPE_IPV4 = 228
+    LINKTYPE_IPV6 = 229
+    LINKTYPE_LINUX_SLL2 = 276
+
+    ETHERTYPE_IPV4 = 0x0800
+    ETHERTYPE_IPV6 = 0x86dd
+    ETHERTYPE_VLAN = [0x8100, 0x88a8, 0x9100]
+
+    IPPROTO_TCP = 6
+    IPPROTO_UDP = 17
+    IPV6_EXTENSION_HEADERS = [0, 43, 60] # hop-by-hop, routing, destination options
+    IPV6_FRAGMENT_HEADER = 44
+
+    PCAP_MAGIC_US = 0xa1b2c3d4
+    PCAP_MAGIC_NS = 0xa1b23c4d
+    PCAPNG_BLOCK_SHB = 0x0a0d0d0a
+    PCAPNG_BLOCK_IDB = 0x00000001
+    PCAPNG_BLOCK_PB = 0x00000002
+    PCAPNG_BLOCK_SPB = 0x00000003
+    PCAPNG_BLOCK_EPB = 0x00000006
+    PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+    PCAPNG_OPTION_TSRESOL = 9
+
+    def __init__(self, filepath, layer=5):
+        assert layer in [2, 3, 4, 5], "the layer should be 2, 3, 4, or 5"
+        self.filepath = filepath
+        self.layer = layer
+        self.num_skipped = 0 # num of records that could not be decoded to the layer
+
+    # yield each record that has the layer: PcapRecord (with the memoryview of the data)
+    # the memoryviews are only valid until the next record, copy them if they are kept
+    def read_records(self):
+        with open(self.filepath, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            view = memoryview(buf)
+            try:
+                magic = view[:4].tobytes()
+                if struct.unpack("<I", magic)[0] == PcapReader.PCAPNG_BLOCK_SHB:
+                    frames = self.read_frames_pcapng(view)
+                else:
+                    frames = self.read_frames_pcap(view)
+
+                for linktype, timestamp, frame in frames:
+                    record = self.decode_frame(linktype, timestamp, frame)
+                    if record is None:
+                        self.num_skipped += 1
+                        continue
+                    try:
+                        yield record
+                    finally:
+                        record.data.release()
+                        frame.release()
+            finally:
+                view.release()
+                try:
+                    buf.close()
+                except BufferError:
+                    # some slices of the records are still kept, the map is closed when they are released
+                    logging.debug("The memoryviews of the pcap file are still used")
+        if self.num_skipped > 0:
+            logging.debug("Number of skipped records: {0}".format(self.num_skipped))
+
+    ## pcap: global header + (record header + data) * n
+    # output: (linktype, timestamp, frame)
+    def read_frames_pcap(self, view):
+        assert len(view) >= 24, "The pcap file is too short"
+        magic = struct.unpack("<I", view[:4])[0]
+        if magic in [PcapReader.PCAP_MAGIC_US, PcapReader.PCAP_MAGIC_NS]:
+            endian = "<"
+        else:
+            magic = struct.unpack(">I", view[:4])[0]
+            endian = ">"
+        assert magic in [PcapReader.PCAP_MAGIC_US, PcapReader.PCAP_MAGIC_NS], "The file is not a pcap/pcapng file"
+        ts_unit = 1e-6 if magic == PcapReader.PCAP_MAGIC_US else 1e-9
+        linktype = struct.unpack(endian + "I", view[20:24])[0] & 0x0fffffff
+
+        record_header = struct.Struct(endian + "IIII")
+        offset = 24
+        while offset + 16 <= len(view):
+            ts_sec, ts_frac, len_captured, len_original = record_header.unpack_from(view, offset)
+            offset += 16
+            if offset + len_captured > len(view):
+                logging.error("The last record of the pcap file is truncated")
+                break
+            yield linktype, ts_sec + ts_frac * ts_unit, view[offset:offset+len_captured]
+            offset += len_captured
+
+    ## pcapng: blocks of (type, length, body, length)
+    # output: (linktype, timestamp, frame)
+    def read_frames_pcapng(self, view):
+        endian = "<"
+        interfaces = list() # (linktype, ts_unit) of each interface of the current section
+
+        offset = 0
+        while offset + 12 <= len(view):
+            block_type = struct.unpack_from(endian + "I", view, offset)[0]
+            if block_type == PcapReader.PCAPNG_BLOCK_SHB:
+                # the byte order of a section is given by its header
+                endian = "<" if struct.unpack_from("<I", view, offset + 8)[0] == PcapReader.PCAPNG_BYTE_ORDER_MAGIC else ">"
+                interfaces = list()
+            block_length = struct.unpack_from(endian + "I", view, offset + 4)[0]
+            if block_length < 12 or offset + block_length > len(view):
+                logging.error("The last block of the pcapng file is truncated")
+                break
+            body = offset + 8
+            body_end = offset + block_length - 4
+
+            if block_type == PcapReader.PCAPNG_BLOCK_IDB:
+                linktype = struct.unpack_from(endian + "H", view, body)[0]
+                interfaces.append((linktype, self.get_pcapng_ts_unit(view, body + 8, body_end, endian)))
+            elif block_type == PcapReader.PCAPNG_BLOCK_EPB or block_type == PcapReader.PCAPNG_BLOCK_PB:
+                if block_type == PcapReader.PCAPNG_BLOCK_EPB:
+                    interface_id, ts_high, ts_low, len_captured, len_original = struct.unpack_from(endian + "IIIII", view, body)
+                else:
+                    interface_id, drops, ts_high, ts_low, len_captured, len_original = struct.unpack_from(endian + "HHIIII", view, body)
+                if interface_id >= len(interfaces):
+                    logging.error("The interface {0} of a packet block is not described, skip the block".format(interface_id))
+                else:
+                    linktype, ts_unit = interfaces[interface_id]
+                    yield linktype, ((ts_high << 32) | ts_low) * ts_unit, view[body+20:body+20+len_captured]
+            elif block_type == PcapReader.PCAPNG_BLOCK_SPB:
+                len_original = struct.unpack_from(endian + "I", view, body)[0]
+                len_captured = min(len_original, body_end - body - 4)
+                if len(interfaces) == 0:
+                    logging.error("The interface of a simple packet block is not described, skip the block")
+                else:
+                    linktype, ts_unit = interfaces[0]
+                    yield linktype, 0.0, view[body+4:body+4+len_captured]
+
+            offset += block_length
+
+    # the if_tsresol option of an interface description block (default: 10^-6)
+    def get_pcapng_ts_unit(self, view, offset, offset_end, endian):
+        while offset + 4 <= offset_end:
+            code, length = struct.unpack_from(endian + "HH", view, offset)
+            if code == 0: # opt_endofopt
+                break
+            if code == PcapReader.PCAPNG_OPTION_TSRESOL and length >= 1:
+                tsresol = view[offset + 4]
+                if tsresol & 0x80:
+                    return 2 ** -(tsresol & 0x7f)
+                return 10 ** -tsresol
+            offset += 4 + ((length + 3) & ~3)
+
+        return 1e-6
+
+    ## decode the headers of a frame down to the layer
+    # output: PcapRecord, or None if the frame doesn't have the layer
+    def decode_frame(self, linktype, timestamp, frame):
+        record = PcapRecord(timestamp)
+        if self.layer == 2:
+            record.data = frame[:]
+            if linktype == PcapReader.LINKTYPE_ETHERNET and len(frame) >= 14:
+                record.l2Protocol = "Ethernet"
+                record.l2DestinationAddress = PcapReader.format_mac(frame[0:6])
+                record.l2SourceAddress = PcapReader.format_mac(frame[6:12])
+            return record
+
+        ## link layer
+        packet = self.decode_link_layer(linktype, frame, record)
+        if packet is None or len(packet) < 1:
+            return None
+
+        ## network layer
+        version = packet[0] >> 4
+        if version == 4 and len(packet) >= 20:
+            len_header = (packet[0] & 0x0f) * 4
+            len_total = struct.unpack_from(">H", packet, 2)[0]
+            if len_total >= len_header:
+                packet = packet[:len_total] # remove the link layer padding
+            protocol = packet[9]
+            record.l3Protocol = "IP"
+            record.l3SourceAddress = socket.inet_ntop(socket.AF_INET, packet[12:16])
+            record.l3DestinationAddress = socket.inet_ntop(socket.AF_INET, packet[16:20])
+        elif version == 6 and len(packet) >= 40:
+            len_payload = struct.unpack_from(">H", packet, 4)[0]
+            packet = packet[:40+len_payload]
+            protocol = packet[6]
+            record.l3Protocol = "IPv6"
+            record.l3SourceAddress = socket.inet_ntop(socket.AF_INET6, packet[8:24])
+            record.l3DestinationAddress = socket.inet_ntop(socket.AF_INET6, packet[24:40])
+            len_header = 40
+            while protocol in PcapReader.IPV6_EXTENSION_HEADERS or protocol == PcapReader.IPV6_FRAGMENT_HEADER:
+                if len_header + 8 > len(packet):
+                    return None
+                len_extension = 8 if protocol == PcapReader.IPV6_FRAGMENT_HEADER else (packet[len_header + 1] + 1) * 8
+                protocol = packet[len_header]
+                len_header += len_extension
+        else:
+            return None
+
+        if self.layer == 3:
+            record.data = packet
+            return record
+
+        ## transport layer
+        segment = packet[len_header:]
+        if protocol == PcapReader.IPPROTO_TCP and len(segment) >= 20:
+            record.l4Protocol = "TCP"
+            len_header = (segment[12] >> 4) * 4
+        elif protocol == PcapReader.IPPROTO_UDP and len(segment) >= 8:
+            record.l4Protocol = "UDP"
+            len_udp = struct.unpack_from(">H", segment, 4)[0]
+            if len_udp >= 8:
+                segment = segment[:len_udp]
+            len_header = 8
+        else:
+            return None
+        record.l4SourcePort, record.l4DestinationPort = struct.unpack_from(">HH", segment, 0)
+
+        if self.layer == 4:
+            record.data = segment
+            return record
+
+        record.data = segment[len_header:]
+        if len(record.data) == 0:
+            return None
+        return record
+
+    # the network layer packet of a frame (None if it is not IPv4/IPv6)
+    def decode_link_layer(self, linktype, frame, record):
+        if linktype == PcapReader.LINKTYPE_ETHERNET:
+            if len(frame) < 14:
+                return None
+            record.l2Protocol = "Ethernet"
+            record.l2DestinationAddress = PcapReader.format_mac(frame[0:6])
+            record.l2SourceAddress = PcapReader.format_mac(frame[6:12])
+            offset = 12
+            ethertype = struct.unpack_from(">H", frame, offset)[0]
+            while ethertype in PcapReader.ETHERTYPE_VLAN and offset + 6 <= len(frame):
+                offset += 4
+                ethertype = struct.unpack_from(">H", frame, offset)[0]
+            offset += 2
+        elif linktype == PcapReader.LINKTYPE_LINUX_SLL:
+            if len(frame) < 16:
+                return None
+            ethertype = struct.unpack_from(">H", frame, 14)[0]
+            offset = 16
+        elif linktype == PcapReader.LINKTYPE_LINUX_SLL2:
+            if len(frame) < 20:
+                return None
+            ethertype = struct.unpack_from(">H", frame, 0)[0]
+            offset = 20
+        elif linktype in [PcapReader.LINKTYPE_RAW, PcapReader.LINKTYPE_IPV4, PcapReader.LINKTYPE_IPV6]:
+            return frame
+        elif linktype in [PcapReader.LINKTYPE_NULL, PcapReader.LINKTYPE_LOOP]:
+            if len(frame) < 4:
+                return None
+            return frame[4:]
+        else:
+            logging.error("The link type {0} is not supported".format(linktype))
+            return None
+
+        if ethertype not in [PcapReader.ETHERTYPE_IPV4, PcapReader.ETHERTYPE_IPV6]:
+            return None
+        return frame[offset:]
+
+    @staticmethod
+    def format_mac(address):
+        return ':'.join("{:02x}".format(b) for b in address)
+
+"""
+A record of PcapReader: the data (memoryview) and the addresses that NetPlier uses
+the attributes have the same names as the arguments of the netzob network messages
+"""
+class PcapRecord:
+    __slots__ = ['date', 'data', 'l2Protocol', 'l2SourceAddress', 'l2DestinationAddress', \
+        'l3Protocol', 'l3SourceAddress', 'l3DestinationAddress', 'l4Protocol', 'l4SourcePort', 'l4DestinationPort']
+
+    def __init__(self, date):
+        self.date = date
+        self.data = None
+        self.l2Protocol, self.l2SourceAddress, self.l2DestinationAddress = None, None, None
+        self.l3Protocol, self.l3SourceAddress, self.l3DestinationAddress = None, None, None
+        self.l4Protocol, self.l4SourcePort, self.l4DestinationPort = None, None, None
+
+    @property
+    def source(self):
+        if self.l4SourcePort is not None:
+            return "{0}:{1}".format(self.l3SourceAddress, self.l4SourcePort)
+        if self.l3SourceAddress is not None:
+            return self.l3SourceAddress
+        return self.l2SourceAddress
+
+    @property
+    def destination(self):
+        if self.l4DestinationPort is not None:
+            return "{0}:{1}".format(self.l3DestinationAddress, self.l4DestinationPort)
+        if self.l3DestinationAddress is not None:
+            return self.l3DestinationAddress
+        return self.l2DestinationAddress
@@ -18,6 +18,7 @@ from sklearn import preprocessing
 import numpy as np
 import copy
 import logging
+import itertools
 
 from factor_graph import MyFactorGraph
 
@@ -30,9 +31,12 @@ class ProbabilisticInference:
 
     BONUS_VALUE_X2K = 0.2
 
-    def __init__(self, pairs_p, pairs_size):
+    def __init__(self, pairs_p, pairs_size, fg_backend=MyFactorGraph.BACKEND_ANALYTIC, batched=True, pairs_range=None):
         self.pairs_p = pairs_p # observation prob
         self.pairs_size = pairs_size
+        self.pairs_range = pairs_range # the (min, max) of the valid observation prob of each test ({test_id: (min, max)}), the range of pairs_p if it is not given
+        self.fg_backend = fg_backend # backend of the factor graph: analytic, pgmpy
+        self.batched = batched # score all candidates in one pass (only for the analytic backend)
 
     # inference
     def execute(self, fid_list = None):
@@ -40,11 +44,28 @@ class ProbabilisticInference:
 
         # update fid_list if it is specified
         if fid_list == None:
-            fid_list = list(pairs_p.keys())
+            fid_list = list(self.pairs_p.keys())
         else:
             fid_list = [fid for fid in fid_list if fid in self.pairs_p]
         logging.debug("fid_list: {}".format(fid_list)) #debug
-        
+
+        if self.batched and self.fg_backend == MyFactorGraph.BACKEND_ANALYTIC:
+            fg_result = self.compute_fg_result_batched(fid_list)
+        else:
+            fg_result = self.compute_fg_result(fid_list)
+
+        logging.debug("\n[++++] Final Result")
+        pk_list_size = len(list(fg_result.values())[0]) # num of different test
+        for i in range(pk_list_size):
+            result = dict()
+            for fid in fg_result:
+                result[fid] = fg_result[fid][i]
+            logging.debug(sorted(result.items(), key=lambda x:x[1], reverse=True))
+
+        return self.get_fid_inferred(fg_result)
+
+    # fg_result: {fid: list of pk}
+    def compute_fg_result(self, fid_list):
         # compute implication probabilities
         self.p_implication = dict()
         for fid in self.pairs_p.keys():
@@ -78,7 +99,7 @@ class ProbabilisticInference:
         fg_result = dict()
         for fid in fid_list:
             pk_list = list() 
-            fg = MyFactorGraph(p_observation=p_observation, p_implication=self.p_implication)
+            fg = MyFactorGraph(p_observation=p_observation, p_implication=self.p_implication, backend=self.fg_backend)
             # can test different constraints together
             # test type (m/r/s/d/v): 0: k2x & x2k, 1: k2x, 2: x2k, -1: not test
             pk_list.append(fg.compute_pk([0,0,0,0,0], fid)) #kv:mrsdv, vk: mrsdv
@@ -91,15 +112,71 @@ class ProbabilisticInference:
             '''
             fg_result[fid] = pk_list
 
-        logging.debug("\n[++++] Final Result")
-        pk_list_size = len(list(fg_result.values())[0]) # num of different test
-        for i in range(pk_list_size):
-            result = dict()
-            for fid in fg_result:
-                result[fid] = fg_result[fid][i]
-            logging.debug(sorted(result.items(), key=lambda x:x[1], reverse=True))
+        return fg_result
 
-        return self.get_fid_inferred(fg_result)
+    # the same as compute_fg_result, but the probabilities of all fids are packed into ragged arrays
+    # (values + offsets of each fid), and all candidates are scored in one pass
+    def compute_fg_result_batched(self, fid_list):
+        fid_all = list(self.pairs_p.keys())
+        num_fid = len(fid_all)
+
+        # test_id: 0: m, 1: r, 2: s, 3: d, 4: v
+        p_observation, p_offsets = list(), list()
+        for test_id in range(5):
+            values, offsets = self.pack_ragged([self.pairs_p[fid][test_id] for fid in fid_all])
+            p_observation.append(values)
+            p_offsets.append(offsets)
+        sizes, size_offsets = self.pack_ragged([self.pairs_size[fid] for fid in fid_all])
+        p_segments = [self.get_segment_ids(offsets) for offsets in p_offsets]
+        size_segments = self.get_segment_ids(size_offsets)
+
+        # compute implication probabilities
+        p_ktox, p_xtok = self.compute_p_implication_batched(p_observation)
+
+        # normalize observation prob
+        p_observation = self.normalize_p_observation_batched(p_observation)
+
+        # adjust observation probabilities by cluster size
+        logging.debug('[++++] Add bonus by size')
+        size_sum = np.bincount(size_segments, weights=sizes, minlength=num_fid)
+        size_ratio = sizes / size_sum[size_segments]
+        for test_id in [0, 1, 2]:
+            assert np.array_equal(p_offsets[test_id], size_offsets), "the number of p should be the same as the number of clusters"
+            p_observation[test_id] = self.add_bonus_value_batched(p_observation[test_id], size_ratio, 0.2)
+
+        # deal with p < 0
+        p_observation, p_ktox, p_xtok, p_segments = self.update_invalid_p_batched(p_observation, p_ktox, p_xtok, p_segments, sizes)
+
+        # factor graph: sum the log messages of all leaves of each fid
+        log_pk0, log_pk1 = np.zeros(num_fid), np.zeros(num_fid)
+        for test_id in range(5):
+            leaf_k0, leaf_k1 = MyFactorGraph.compute_leaf_messages(p_observation[test_id], p_ktox[test_id], p_xtok[test_id])
+            with np.errstate(divide='ignore'):
+                log_pk0 += np.bincount(p_segments[test_id], weights=np.log(leaf_k0), minlength=num_fid)
+                log_pk1 += np.bincount(p_segments[test_id], weights=np.log(leaf_k1), minlength=num_fid)
+        pk = MyFactorGraph.normalize_log_pk(log_pk0, log_pk1)
+
+        dict_fid_i = {fid: i for i, fid in enumerate(fid_all)}
+        fg_result = dict()
+        for fid in fid_list:
+            fg_result[fid] = [pk[dict_fid_i[fid]]]
+
+        return fg_result
+
+    # list of lists -> values, offsets (the values of list i are values[offsets[i]:offsets[i+1]])
+    @staticmethod
+    def pack_ragged(lists):
+        lengths = [len(l) for l in lists]
+        offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        values = np.fromiter(itertools.chain.from_iterable(lists), dtype=np.float64, count=offsets[-1])
+
+        return values, offsets
+
+    # offsets -> the list index of each value
+    @staticmethod
+    def get_segment_ids(offsets):
+        return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
 
     def print_p_lists(self, fid_list, p_observation, p_implication = None):
         for fid in fid_list:
@@ -189,6 +266,19 @@ class ProbabilisticInference:
 
         return p_implication
 
+    # the same as compute_p_implication for all fids
+    def compute_p_implication_batched(self, p_observation):
+        p_ktox_const = [ProbabilisticInference.P_K2M, ProbabilisticInference.P_K2R, ProbabilisticInference.P_K2S, ProbabilisticInference.P_K2D, ProbabilisticInference.P_K2V]
+        p_xtok_const = [ProbabilisticInference.P_M2K, ProbabilisticInference.P_R2K, ProbabilisticInference.P_S2K, ProbabilisticInference.P_D2K, ProbabilisticInference.P_V2K]
+
+        p_ktox = [np.full(len(p_observation[test_id]), p_ktox_const[test_id]) for test_id in range(5)]
+        p_xtok = [np.full(len(p_observation[test_id]), p_xtok_const[test_id]) for test_id in range(5)]
+
+        return p_ktox, p_xtok
+
+    def add_bonus_value_batched(self, p_values, size_ratio, bonus_value):
+        return np.where(p_values > 0, p_values + bonus_value * size_ratio, p_values)
+
     #### Normalization and Standardization
     def normalize_p_observation(self, p_observation):
         logging.debug("\n[++++] Normalize P_lists")
@@ -211,8 +301,7 @@ class ProbabilisticInference:
                 #    p_list_total = self.standardize(p_list_total)
                 #p_list_total = self.normalize_max_min(p_list_total)
 
-                p_list_total_min = np.min(p_list_total)
-                p_list_total_max = np.max(p_list_total)
+                p_list_total_min, p_list_total_max = self.get_p_range(test_id, p_list_total)
                 if p_list_total_min != p_list_total_max:
                     p_list_total = self.normalize_range(p_list_total, p_list_total_min, p_list_total_max, 0.2, 0.80) #[0.1, 0.95]
                 else:
@@ -220,8 +309,7 @@ class ProbabilisticInference:
                     p_list_total = [p_balance for p in p_list_total]
                     #p_list_total = [0.5 for p in p_list_total]
             elif test_id in [1]: # rc
-                p_list_total_min = np.min(p_list_total)
-                p_list_total_max = np.max(p_list_total)
+                p_list_total_min, p_list_total_max = self.get_p_range(test_id, p_list_total)
                 if p_list_total_min != p_list_total_max:
                     #p_list_total = self.normalize_range(p_list_total, p_list_total_min, p_list_total_max, 0.2, 0.8)
                     p_list_total = self.normalize_range(p_list_total, 0, 1, 0.2, 0.8)
@@ -233,8 +321,7 @@ class ProbabilisticInference:
                 #if len(p_list_total) > 1:
                 #    p_list_total = self.standardize(p_list_total)
 
-                p_list_total_min = np.min(p_list_total)
-                p_list_total_max = np.max(p_list_total)
+                p_list_total_min, p_list_total_max = self.get_p_range(test_id, p_list_total)
                 if p_list_total_min != p_list_total_max:
                     #p_list_total = self.normalize_range(p_list_total, p_list_total_min, p_list_total_max, 0.2, 0.8)
                     p_list_total = self.normalize_range(p_list_total, 0, 1, 0.2, 0.8)
@@ -243,8 +330,7 @@ class ProbabilisticInference:
                     p_list_total = [p_balance for p in p_list_total]
                     #p_list_total = [0.5 for p in p_list_total]
             elif test_id in [3]: # d
-                p_list_total_min = np.min(p_list_total)
-                p_list_total_max = np.max(p_list_total)
+                p_list_total_min, p_list_total_max = self.get_p_range(test_id, p_list_total)
                 if p_list_total_min != p_list_total_max:
                     #p_list_total = self.normalize_range(p_list_total, p_list_total_min, p_list_total_max, 0.1, 0.75)
                     p_list_total = self.normalize_range(p_list_total, 0, 1, 0.1, 0.75)
@@ -277,6 +363,42 @@ class ProbabilisticInference:
 
         return p_observation
 
+    # the same as normalize_p_observation, p_observation: list of packed values of each test
+    def normalize_p_observation_batched(self, p_observation):
+        logging.debug("\n[++++] Normalize P_lists")
+
+        # test_id: [p_balance if all values are the same, boundary of the original range, target range]
+        normalization_rules = {
+            0: [MyFactorGraph.compute_fg_threshold(ProbabilisticInference.P_K2M, ProbabilisticInference.P_M2K), None, (0.2, 0.80)],
+            1: [MyFactorGraph.compute_fg_threshold(ProbabilisticInference.P_K2R, ProbabilisticInference.P_R2K), (0, 1), (0.2, 0.8)],
+            2: [MyFactorGraph.compute_fg_threshold(ProbabilisticInference.P_K2S, ProbabilisticInference.P_S2K), (0, 1), (0.2, 0.8)],
+            3: [0.95, (0, 1), (0.1, 0.75)],
+        }
+        for test_id, (p_balance, range_origin, range_target) in normalization_rules.items():
+            p_values = p_observation[test_id].copy()
+            valid = p_values >= 0
+            if not np.any(valid):
+                continue
+
+            p_list_total = p_values[valid]
+            p_list_total_min, p_list_total_max = self.get_p_range(test_id, p_list_total)
+            if p_list_total_min != p_list_total_max:
+                min1, max1 = range_origin if range_origin else (p_list_total_min, p_list_total_max)
+                min2, max2 = range_target
+                p_values[valid] = min2 + (p_list_total - min1)*(max2 - min2)/(max1 - min1)
+            else:
+                p_values[valid] = p_balance
+            p_observation[test_id] = p_values
+
+        return p_observation
+
+    # the (min, max) of the valid observation prob of the test
+    def get_p_range(self, test_id, p_list_total):
+        if self.pairs_range is not None and self.pairs_range.get(test_id) is not None:
+            return self.pairs_range[test_id]
+
+        return np.min(p_list_total), np.max(p_list_total)
+
     def normalize_max_min(self, p_list):
         # Min-Max Normalization
         """#method 1: use numpy
@@ -375,6 +497,32 @@ class ProbabilisticInference:
 
         return p_observation
 
+    # the same as update_invalid_p for the packed values
+    def update_invalid_p_batched(self, p_observation, p_ktox, p_xtok, p_segments, sizes):
+        logging.debug("[++++] Update invalid p")
+
+        # m
+        p_balance = MyFactorGraph.compute_fg_threshold(ProbabilisticInference.P_K2M, ProbabilisticInference.P_M2K)
+        p_m = p_observation[0]
+        p_observation[0] = np.where(p_m < 0, np.where(p_m < -1.5, p_balance, 0.4), p_m)
+
+        # r: remove -1 (the messages that have no request/response) and the clusters with one message
+        i_filter = (p_observation[1] > 0) & (sizes > 1)
+        p_observation[1] = p_observation[1][i_filter]
+        p_ktox[1] = p_ktox[1][i_filter]
+        p_xtok[1] = p_xtok[1][i_filter]
+        p_segments[1] = p_segments[1][i_filter]
+
+        # s, d
+        for test_id in [2, 3]:
+            p_observation[test_id] = np.where(p_observation[test_id] < 0, 0.4, p_observation[test_id])
+
+        # v
+        p_balance = MyFactorGraph.compute_fg_threshold(ProbabilisticInference.P_K2V, ProbabilisticInference.P_V2K)
+        p_observation[4] = np.where(p_observation[4] < 0, p_balance - 0.45, 0.95)
+
+        return p_observation, p_ktox, p_xtok, p_segments
+
     # TODO: add algorithms to infer the fid from fg results
     def get_fid_inferred(self, fg_result, max_num=1, precision=0.01):
         result = dict()
@@ -15,23 +15,68 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>
 
 import logging
-import copy
 import struct
+import numpy as np
 from netzob.Import.PCAPImporter.all import *
-from netzob.Model.Vocabulary.Session import Session
-
+from netzob.Model.Vocabulary.Messages.L2NetworkMessage import L2NetworkMessage
+from netzob.Model.Vocabulary.Messages.L3NetworkMessage import L3NetworkMessage
+from netzob.Model.Vocabulary.Messages.L4NetworkMessage import L4NetworkMessage
+
+from pcap_reader import PcapReader
+from protocol_spec import ProtocolSpec
+from flow_table import FlowTable
+
+# the rotating key of zeroaccess for num_words words (the key is rotated left by 1 bit after each word)
+def generate_za_key_schedule(key, num_words):
+    keys = np.empty(num_words, dtype='<u4')
+    for i in range(min(num_words, 32)):
+        keys[i] = key
+        key = ((key << 1) & 0xffffffff | key >> 31)
+    # the key repeats every 32 words
+    if num_words > 32:
+        keys[32:] = np.resize(keys[:32], num_words - 32)
+
+    return keys
+
+"""
+reader: netzob (default), native
+netzob: import all packets with the PCAPImporter of netzob
+native: stream the packets with PcapReader (pcap/pcapng, memory-mapped), only the payloads of the imported messages are copied
+"""
 class Processing:
     MAX_LEN = 500 #100 // reduce the time for MSA
-
-    def __init__(self, filepath, protocol_type=None, layer=5, messages=None):
+    READER_NETZOB = "netzob"
+    READER_NATIVE = "native"
+    ZA_KEY = 0x66747032
+    ZA_KEY_SCHEDULE = generate_za_key_schedule(ZA_KEY, MAX_LEN // 4)
+
+    # ingest stages: applied to the data of each message in order when it is imported
+    # a stage returns the new data, or None to drop the message
+    STAGE_SIGNATURE = "signature" # (offset, value): drop the msgs without value at offset
+    STAGE_STRIP_IP_HEADER = "strip_ip_header" # extract from IP msgs
+    STAGE_CLIP_MODBUS = "clip_modbus" # in mb2, some msgs contain more than one mbtcp
+    STAGE_DECRYPT_ZEROACCESS = "decrypt_zeroaccess"
+    STAGE_TRUNCATE = "truncate" # (length)
+    INGEST_STAGES = {
+        'icmp': [(STAGE_STRIP_IP_HEADER,)],
+        'modbus': [(STAGE_CLIP_MODBUS,)],
+        'smb': [(STAGE_SIGNATURE, 4, bytes.fromhex("ff534d42")), (STAGE_TRUNCATE, 500)],
+        'smb2': [(STAGE_SIGNATURE, 4, bytes.fromhex("fe534d42")), (STAGE_TRUNCATE, 500)],
+        'zeroaccess': [(STAGE_DECRYPT_ZEROACCESS,)],
+    }
+
+    def __init__(self, filepath, protocol_type=None, layer=5, messages=None, reader=READER_NETZOB):
         self.filepath = filepath
         self.protocol_type = protocol_type
         self.layer = layer
         self.messages = messages
+        self.reader = reader
         self.direction_list = list()
+        self.flow_table = None
 
         if self.protocol_type:
-            assert self.protocol_type in ['dhcp', 'dnp3', 'icmp', 'modbus', 'ntp', 'smb', 'smb2', 'tftp', 'zeroaccess'], 'the protocol_type is unknown'
+            assert ProtocolSpec.get(self.protocol_type) is not None, 'the protocol_type is unknown'
+        assert self.reader in [Processing.READER_NETZOB, Processing.READER_NATIVE], 'the reader should be netzob or native'
         self.import_messages()
         self.get_msgs_directionlist()
 
@@ -42,197 +87,169 @@ class Processing:
         # ICMP: layer = 3
         if self.protocol_type == 'icmp':
             self.layer = 3
-        messages = PCAPImporter.readFile(filePath=self.filepath, importLayer=self.layer).values()
+        stages = self.get_ingest_stages()
+        if self.reader == Processing.READER_NATIVE:
+            messages = self.read_messages_native(stages)
+        else:
+            messages = PCAPImporter.readFile(filePath=self.filepath, importLayer=self.layer).values()
+
+            ## Filter messages (all msgs are in memory, apply each stage to all of them)
+            data_list = self.apply_ingest_stages_bulk([message.data for message in messages], stages)
+            messages_filtered = list()
+            for message,data in zip(messages, data_list):
+                if data is None:
+                    continue
+                if data is not message.data:
+                    message.data = data
+                messages_filtered.append(message)
+            messages = messages_filtered
 
-        ## Filter messages
-        # extract from IP msgs
-        if self.protocol_type == "icmp":
-            for message in messages:
-                len_header = message.data[0] & 0x0000000f
+        self.messages = messages
+        # the sessions are built once and shared by the following stages
+        self.flow_table = FlowTable(self.messages)
+
+    # the stages of the protocol, then MAX_LEN = 500
+    def get_ingest_stages(self):
+        stages = list(Processing.INGEST_STAGES.get(self.protocol_type, list()))
+        stages.append((Processing.STAGE_TRUNCATE, Processing.MAX_LEN))
+
+        return stages
+
+    # data: bytes or memoryview
+    # output: the data after all stages, or None if the message is dropped
+    def apply_ingest_stages(self, data, stages):
+        for stage in stages:
+            if stage[0] == Processing.STAGE_SIGNATURE:
+                offset, value = stage[1], stage[2]
+                if data[offset:offset+len(value)] != value:
+                    return None
+            elif stage[0] == Processing.STAGE_STRIP_IP_HEADER:
+                len_header = data[0] & 0x0000000f
                 startIndex = len_header * 4 #*32/8
-                message.data = message.data[startIndex:]
-        # in mb2, some msgs contain more than one mbtcp
-        elif self.protocol_type == 'modbus':
-            for i, message in enumerate(messages):
-                length = int.from_bytes(message.data[4:4+2], byteorder='big', signed=True)
-                if len(message.data) != length + 6:
-                    message.data = message.data[:length+6]
-        elif self.protocol_type == 'smb':
-            for message in messages[::-1]:
-                # delete not smb msgs
-                if message.data[4:8].hex() != "ff534d42":
-                    messages.remove(message)
-                if len(message.data) > 500:
-                    message.data = message.data[:500]
-        elif self.protocol_type == 'smb2':
-            for message in messages[::-1]:
-                if message.data[4:8].hex() != "fe534d42":
-                    messages.remove(message)
-                if len(message.data) > 500:
-                    message.data = message.data[:500]
-        elif self.protocol_type == 'zeroaccess':
-            for message in messages:
-                message.data = self.decrypt_za_msg(message.data)
-
-        # MAX_LEN = 500 
-        for message in messages:
-            if len(message.data) > Processing.MAX_LEN:
-                message.data = message.data[:Processing.MAX_LEN]
+                data = data[startIndex:]
+            elif stage[0] == Processing.STAGE_CLIP_MODBUS:
+                length = int.from_bytes(data[4:4+2], byteorder='big', signed=True)
+                if len(data) != length + 6:
+                    data = data[:length+6]
+            elif stage[0] == Processing.STAGE_DECRYPT_ZEROACCESS:
+                data = self.decrypt_za_msg(data)
+            elif stage[0] == Processing.STAGE_TRUNCATE:
+                if len(data) > stage[1]:
+                    data = data[:stage[1]]
+            else:
+                logging.error("The ingest stage is unknown: {}".format(stage[0]))
+
+        return data
+
+    # data_list: the data of all messages
+    # output: the data of each message after all stages, or None if the message is dropped
+    def apply_ingest_stages_bulk(self, data_list, stages):
+        data_list = list(data_list)
+        for stage in stages:
+            ids_kept = [i for i,data in enumerate(data_list) if data is not None]
+            if stage[0] == Processing.STAGE_DECRYPT_ZEROACCESS:
+                data_decrypted = self.decrypt_za_msgs([data_list[i] for i in ids_kept])
+                for i,data in zip(ids_kept, data_decrypted):
+                    data_list[i] = data
+            else:
+                for i in ids_kept:
+                    data_list[i] = self.apply_ingest_stages(data_list[i], [stage])
+
+        return data_list
+
+    # the stages are applied to the memoryview of each record, only the kept messages are copied
+    def read_messages_native(self, stages=None):
+        stages = stages if stages is not None else self.get_ingest_stages()
+        messages = list()
+        for record in PcapReader(filepath=self.filepath, layer=self.layer).read_records():
+            data = self.apply_ingest_stages(record.data, stages)
+            if data is None:
+                continue
+            messages.append(self.create_message(record, data))
+            if isinstance(data, memoryview):
+                data.release()
+
+        return messages
+
+    # PcapRecord -> netzob message (the data is copied from the memoryview)
+    @staticmethod
+    def create_message(record, data=None):
+        data = record.data if data is None else data
+        data = data.tobytes() if isinstance(data, memoryview) else data
+        if record.l4Protocol is not None:
+            return L4NetworkMessage(data=data, date=record.date, \
+                l2Protocol=record.l2Protocol, l2SourceAddress=record.l2SourceAddress, l2DestinationAddress=record.l2DestinationAddress, \
+                l3Protocol=record.l3Protocol, l3SourceAddress=record.l3SourceAddress, l3DestinationAddress=record.l3DestinationAddress, \
+                l4Protocol=record.l4Protocol, l4SourcePort=record.l4SourcePort, l4DestinationPort=record.l4DestinationPort)
+        if record.l3Protocol is not None:
+            return L3NetworkMessage(data=data, date=record.date, \
+                l2Protocol=record.l2Protocol, l2SourceAddress=record.l2SourceAddress, l2DestinationAddress=record.l2DestinationAddress, \
+                l3Protocol=record.l3Protocol, l3SourceAddress=record.l3SourceAddress, l3DestinationAddress=record.l3DestinationAddress)
+        return L2NetworkMessage(data=data, date=record.date, \
+            l2Protocol=record.l2Protocol, l2SourceAddress=record.l2SourceAddress, l2DestinationAddress=record.l2DestinationAddress)
+
+    # the key schedule of num_words words (precomputed up to MAX_LEN/4 words)
+    @staticmethod
+    def get_za_key_schedule(num_words):
+        if num_words <= len(Processing.ZA_KEY_SCHEDULE):
+            return Processing.ZA_KEY_SCHEDULE[:num_words]
+        return generate_za_key_schedule(Processing.ZA_KEY, num_words)
 
-        self.messages = messages
+    # the num of words decrypted from a msg of length (the last word is dropped, even if it is complete)
+    @staticmethod
+    def get_za_num_words(length):
+        return max(length - 1, 0) // 4
 
+    # messagedata_encrypted: bytes or memoryview
     def decrypt_za_msg(self, messagedata_encrypted):
         crc32 = struct.unpack("<I", messagedata_encrypted[0:4])[0]
         if crc32 == 0:
             return messagedata_encrypted
 
-        key = 0x66747032
-        result = []
-        for i in range(0, len(messagedata_encrypted), 4):
-            if (i + 4) >= len(messagedata_encrypted):
-                break
-            sub_data = struct.unpack("<I", messagedata_encrypted[i:i+4])[0]
-            xored_subdata = sub_data ^ key
-            decrpted_data = struct.pack("<I", xored_subdata)
-            result.append(decrpted_data.hex())
-            key = ((key << 1) & 0xffffffff | key >> 31)
-        messagedata_decrypted = ''.join(result)
-        
-        return bytes.fromhex(messagedata_decrypted)
+        num_words = Processing.get_za_num_words(len(messagedata_encrypted))
+        words = np.frombuffer(messagedata_encrypted, dtype='<u4', count=num_words)
+
+        return (words ^ Processing.get_za_key_schedule(num_words)).tobytes()
+
+    # decrypt all msgs at once: one xor over the words of all msgs
+    def decrypt_za_msgs(self, data_list):
+        data_list = list(data_list)
+        ids_encrypted = [i for i,data in enumerate(data_list) if struct.unpack("<I", data[0:4])[0] != 0]
+        if len(ids_encrypted) == 0:
+            return data_list
+
+        nums_words = np.array([Processing.get_za_num_words(len(data_list[i])) for i in ids_encrypted], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(nums_words)))
+        words = np.frombuffer(b''.join([data_list[i][:n*4] for i,n in zip(ids_encrypted, nums_words.tolist())]), dtype='<u4')
+        # the key of each word: the schedule from the first word of its msg
+        positions = np.arange(offsets[-1]) - np.repeat(offsets[:-1], nums_words)
+        words_decrypted = (words ^ Processing.get_za_key_schedule(32).take(positions & 31)).tobytes()
+
+        offsets = (offsets * 4).tolist()
+        for j,i in enumerate(ids_encrypted):
+            data_list[i] = words_decrypted[offsets[j]:offsets[j+1]]
+
+        return data_list
 
     ## generate direction list
     def get_msgs_directionlist(self):
         assert self.messages is not None, 'the messages could not be None'
 
-        if not self.protocol_type or self.protocol_type == "tftp":
+        spec = ProtocolSpec.get(self.protocol_type) if self.protocol_type else None
+        if spec is None or spec.direction is None:
             direction_list = self.get_msgs_directionlist_by_sessions()
         else: ## get the direction by specification
-            direction_list = list()
-            for message in self.messages:
-                d = self.get_msg_direction_by_specification(message)
-                if d != 0 and d != 1:
-                    logging.error("Error: GetMsgsDirectionlistBySpecification")
-                direction_list.append(d)
+            direction_list = spec.get_directions(self.messages)
+            if -1 in direction_list:
+                logging.error("Error: GetMsgsDirectionlistBySpecification")
 
         self.direction_list = direction_list
 
     def get_msgs_directionlist_by_sessions(self):
-        dict_idtoi = dict()
-        for i,message in enumerate(self.messages):
-            dict_idtoi[message.id] = i
-
-        direction_list = [-1]*len(self.messages)
-
-        sessions = Session(self.messages)
-        #print(sessions.getEndpointsList())
-        #logging.info("Number of Sessions: {0}".format(len(sessions.getTrueSessions())))
-        for session in sessions.getTrueSessions():
-            messages_list = list(session.messages.values())
-            messages_list = sorted(messages_list, key=lambda x:x.date)
-
-            srcIP = messages_list[0].source
-            for message in messages_list:
-                if message.source == srcIP:
-                    result = 0
-                else:
-                    result = 1
-                direction_list[dict_idtoi[message.id]] = result
-
-        return direction_list
-
-    def get_msg_direction_by_specification(self, message):
-        ##0: request; 1: response
-        result = -1
-
-        if self.protocol_type == "dhcp":
-            #DHCP: original msgs data[0]; aligned msg (hex) data[1]
-            if message.data[0] == 1:
-                result = 0
-            elif message.data[0] == 2:
-                result = 1
-            else:
-                logging.error("Can not decide the direction of msg: {}".format(message.data[0]))
-        elif self.protocol_type == "dnp3":
-            f = (message.data[3] >> 7) & 0x01
-            #1: from master
-            #0: from outstation
-            if f == 1:
-                result = 0
-            elif f == 0:
-                result = 1
-            else:
-                logging.error("Can not decide the direction of msg: {}".format(f))
-        elif self.protocol_type == "ftp":
-            port_source, port_destination = message.source.split(":")[1], message.destination.split(":")[1]
-            server_port = ["20", "21"]
-            if port_source in server_port:
-                result = 1
-            elif port_destination in server_port:
-                result = 0
-            else:
-                logging.error("Can not decide the direction of msg port: {} {}".format(message.source, message.destination))
-        elif self.protocol_type == "icmp":
-            ##9/10: not sure
-            if message.data[0] in [8, 13, 15, 17, 10]:
-                result = 0
-            elif message.data[0] in [0, 3, 4, 5, 11, 12, 14, 16, 18, 9]:
-                result = 1
-            else:
-                logging.error("Can not decide the direction of msg: {}".format(message.data[0]))
-        elif self.protocol_type == "modbus":
-            port_source, port_destination = message.source.split(":")[1], message.destination.split(":")[1]
-            if port_source == "502":
-                result = 1
-            elif port_destination == "502":
-                result = 0
-            else:
-                logging.error("Can not decide the direction of msg port: {} {}".format(message.source, message.destination))
-        elif self.protocol_type == "ntp":
-            f = message.data[0] & 0x07
-            #1: symmetric active; 2: Symmetric Passive
-            #3: client; 4: server;
-            #5: broadcast server; 6: Broadcast Client
-            if f == 1 or f == 3 or f == 5:
-                result = 0
-            elif f == 2 or f == 4 or f == 6:
-                result = 1
-            else:
-                logging.error("Can not decide the direction of msg: {}".format(f))
-        elif self.protocol_type == "smb":
-            smb_flag = message.data[4+9]
-            direction = smb_flag & 0x80
-            if direction == 0:
-                result = 0
-            elif direction == 128:
-                result = 1
-            else:
-                print("Can not decide the direction of msg: {}".format(direction))
-        elif self.protocol_type == "smb2":
-            #print(message.data[4+16:4+16+4].hex())
-            smb_flag = struct.unpack("<I", message.data[4+16:4+16+4])[0]
-            direction = smb_flag & 0x1
-            #print(direction, type(direction))
-            if direction == 0:
-                result = 0
-            elif direction == 1:
-                result = 1
-            else:
-                logging.error("Can not decide the direction of msg: {}".format(direction))
-        elif self.protocol_type == "zeroaccess":
-            #g: 103; r: 114; n: 110
-            if message.data[7] == 103:
-                result = 0
-            elif (message.data[7] == 114) or (message.data[7] == 110):
-                result = 1
-            else:
-                logging.error("Can not decide the direction of msg: {}".format(message.data[7]))
-        else:
-            logging.error("The protocol_type is not unknown to detect direction")
-
-        if result == -1:
-            logging.error("Error: can't decide the drection: {0}".format(message.data))
+        if self.flow_table is None:
+            self.flow_table = FlowTable(self.messages)
 
-        return result
+        return self.flow_table.get_directions().tolist()
 
     def print_dataset_info(self):
         assert self.protocol_type is not None, 'need the protocol_type to get dataset info'
@@ -243,8 +260,9 @@ class Processing:
         print("Total msg number: {0}\nRequest msg number: {1}\nResponse msg number: {2}\n".format(len(self.messages), len(messages_request), len(messages_response)))
 
         ## True types info
-        types_list_request = [self.get_true_keyword(message) for message in messages_request]
-        types_list_response = [self.get_true_keyword(message) for message in messages_response]
+        spec = ProtocolSpec.get(self.protocol_type)
+        types_list_request = spec.get_keywords(messages_request)
+        types_list_response = spec.get_keywords(messages_response)
         print("Request Symbols: {}".format(set(types_list_request)))
         print("Response Symbols: {}".format(set(types_list_response)))
 
@@ -256,12 +274,7 @@ class Processing:
             print("  Symbol {0} msgs numbers: {1}".format(s, types_list_response.count(s)))
 
         ## Session info
-        messages = copy.deepcopy(self.messages)
-        sessions = Session(messages)
-        for i in range(len(self.direction_list)):
-            data = [messages[i].data, self.direction_list[i]]
-            messages[i].data = data
-        num_of_session = len(sessions.getTrueSessions())
+        num_of_session = self.flow_table.get_num_sessions()
         print("\nNumber of Sessions: {0}".format(num_of_session))
         print("[++++++++] End\n")
 
@@ -276,34 +289,3 @@ class Processing:
                 messages_response.append(messages[i])
 
         return messages_request,messages_response
-
-    # get the true keyword defined by the specification
-    def get_true_keyword(self, message):
-        if self.protocol_type == "dhcp":
-            kw = message.data[242:243]
-        elif self.protocol_type == "dnp3":
-            kw = message.data[12:13]
-        elif self.protocol_type == "ftp":
-            kw = re.split(" |-|\r|\n", message.data.decode())[0]
-        elif self.protocol_type ==  "icmp":
-            kw = message.data[0:2]
-        elif self.protocol_type == "modbus":
-            kw = message.data[7:8]
-        elif self.protocol_type == "ntp":
-            kw = message.data[0] & 0x07
-        elif self.protocol_type == "smb":
-            kw = message.data[4+4]
-        elif self.protocol_type == "smb2":
-            kw = struct.unpack("<H", message.data[4+12:4+12+2])[0]
-        elif self.protocol_type == "tftp":
-            kw = message.data[0:2]
-        elif self.protocol_type == "zeroaccess":
-            kw = message.data[4:8]
-        else:
-            logging.error("The TestName is not given known method for detecting direction.")
-
-        if type(kw).__name__ == "bytes":
-            kw = str(kw.hex())
-    
-        return kw
-    
\ No newline at end of file
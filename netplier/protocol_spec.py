@@ -0,0 +1,254 @@
+# This file is part of NetPlier, a tool for binary protocol reverse engineering.
+# Copyright (C) 2021 Yapeng Ye
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>
+
+import re
+import logging
+import numpy as np
+
+"""
+The data of a batch of messages as a matrix, read by the rules of the protocol specs
+matrix: the first width bytes of each message (padded with 0)
+lengths: the length of each message
+"""
+class MessageBatch:
+    HEX_CHARS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+
+    def __init__(self, messages, width):
+        self.messages = messages
+        data_list = [message.data[:width] for message in messages]
+        self.lengths = np.array([len(message.data) for message in messages], dtype=np.int64)
+
+        lengths_clipped = np.minimum(self.lengths, width)
+        self.matrix = np.zeros((len(messages), width), dtype=np.uint8)
+        self.matrix[np.arange(width) < lengths_clipped[:, None]] = np.frombuffer(b''.join(data_list), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    # the hex string of data[il:ir] of each message (cut at the end of the message)
+    def get_hex(self, il, ir):
+        columns = self.matrix[:, il:ir]
+        chars = np.empty((len(self), 2 * (ir - il)), dtype=np.uint8)
+        chars[:, 0::2] = MessageBatch.HEX_CHARS[columns >> 4]
+        chars[:, 1::2] = MessageBatch.HEX_CHARS[columns & 0x0f]
+        ends = 2 * (np.clip(self.lengths, il, ir) - il)
+
+        return [row[:end].tobytes().decode('ascii') for row,end in zip(chars, ends.tolist())]
+
+    # the unsigned integer data[offset:offset+size] of each message
+    # output: the values, and whether each message is long enough
+    def get_uint(self, offset, size, byteorder):
+        columns = self.matrix[:, offset:offset+size].astype(np.int64)
+        if byteorder == 'little':
+            columns = columns[:, ::-1]
+        values = np.zeros(len(self), dtype=np.int64)
+        for k in range(size):
+            values = (values << 8) | columns[:, k]
+
+        return values, self.lengths >= offset + size
+
+    # the ports of the source and destination of each message (str)
+    # the L4 ports of the message are used if it has them, otherwise the port of the endpoint ("ip:port", the ip may be IPv6)
+    # the endpoints are split once for all messages
+    def get_ports(self):
+        dict_endpoint_port = dict()
+        ports_source, ports_destination = list(), list()
+        for message in self.messages:
+            for endpoint, port, ports in [(message.source, getattr(message, 'l4SourcePort', None), ports_source), \
+                    (message.destination, getattr(message, 'l4DestinationPort', None), ports_destination)]:
+                if port is not None:
+                    ports.append(str(port))
+                    continue
+                if endpoint not in dict_endpoint_port:
+                    dict_endpoint_port[endpoint] = endpoint.rsplit(":", 1)[1]
+                ports.append(dict_endpoint_port[endpoint])
+
+        return np.array(ports_source), np.array(ports_destination)
+
+"""
+A value of the messages: (data[offset:offset+size] >> shift) & mask
+"""
+class ValueRule:
+
+    def __init__(self, offset, size=1, byteorder='big', shift=0, mask=None):
+        self.offset = offset
+        self.size = size
+        self.byteorder = byteorder
+        self.shift = shift
+        self.mask = mask
+        self.width = offset + size
+
+    def extract(self, batch):
+        values, valid = batch.get_uint(self.offset, self.size, self.byteorder)
+        values = values >> self.shift
+        if self.mask is not None:
+            values = values & self.mask
+
+        return values, valid
+
+"""
+The direction of a message from a value of its data
+requests/responses: the values of the requests/responses
+"""
+class DirectionByValue:
+
+    def __init__(self, value, requests, responses):
+        self.value = value
+        self.requests = list(requests)
+        self.responses = list(responses)
+        self.width = value.width
+
+    def extract(self, batch):
+        values, valid = self.value.extract(batch)
+        directions = np.full(len(batch), -1, dtype=np.int64)
+        directions[valid & np.isin(values, self.responses)] = 1
+        directions[valid & np.isin(values, self.requests)] = 0
+
+        return directions
+
+"""
+The direction of a message from its ports
+server_ports: the msgs from the server ports are responses, the msgs to them are requests
+"""
+class DirectionByPort:
+
+    def __init__(self, server_ports):
+        self.server_ports = [str(port) for port in server_ports]
+        self.width = 0
+
+    def extract(self, batch):
+        ports_source, ports_destination = batch.get_ports()
+        directions = np.full(len(batch), -1, dtype=np.int64)
+        directions[np.isin(ports_destination, self.server_ports)] = 0
+        directions[np.isin(ports_source, self.server_ports)] = 1
+
+        return directions
+
+"""
+The keyword of a message: the hex string of data[il:ir]
+"""
+class KeywordByBytes:
+
+    def __init__(self, il, ir):
+        self.il = il
+        self.ir = ir
+        self.width = ir
+
+    def extract(self, batch):
+        return batch.get_hex(self.il, self.ir)
+
+"""
+The keyword of a message: a value of its data (int)
+"""
+class KeywordByValue:
+
+    def __init__(self, value):
+        self.value = value
+        self.width = value.width
+
+    def extract(self, batch):
+        values, valid = self.value.extract(batch)
+        if not valid.all():
+            logging.error("Can not get the keyword of {} msgs: the msgs are too short".format(int((~valid).sum())))
+
+        return [v if is_valid else None for v,is_valid in zip(values.tolist(), valid.tolist())]
+
+"""
+The keyword of a text message: the first token split by the pattern
+"""
+class KeywordByText:
+
+    def __init__(self, pattern):
+        self.pattern = re.compile(pattern)
+        self.width = 0
+
+    def extract(self, batch):
+        return [self.pattern.split(message.data.decode())[0] for message in batch.messages]
+
+"""
+Specification of a protocol, for the direction and the true keyword of each message
+direction: the rule deciding the direction of a msg (0: request; 1: response), None: decided by sessions
+keyword: the rule extracting the true keyword of a msg (bytes are given as hex strings)
+a protocol is added by registering its spec
+"""
+class ProtocolSpec:
+    SPECS = dict()
+
+    def __init__(self, name, direction=None, keyword=None):
+        self.name = name
+        self.direction = direction
+        self.keyword = keyword
+
+    @staticmethod
+    def register(spec):
+        ProtocolSpec.SPECS[spec.name] = spec
+
+    @staticmethod
+    def get(name):
+        return ProtocolSpec.SPECS.get(name)
+
+    # the direction of each msg (-1: can't decide)
+    def get_directions(self, messages):
+        assert self.direction is not None, "The direction of {} is not given by the specification".format(self.name)
+        batch = MessageBatch(messages, self.direction.width)
+        directions = self.direction.extract(batch).tolist()
+        for message,d in zip(messages, directions):
+            if d == -1:
+                logging.error("Can not decide the direction of msg: {0}".format(message.data))
+
+        return directions
+
+    # the true keyword of each msg
+    def get_keywords(self, messages):
+        assert self.keyword is not None, "The keyword of {} is not given by the specification".format(self.name)
+        batch = MessageBatch(messages, self.keyword.width)
+
+        return self.keyword.extract(batch)
+
+ProtocolSpec.register(ProtocolSpec('dhcp',
+    direction=DirectionByValue(ValueRule(0), requests=[1], responses=[2]),
+    keyword=KeywordByBytes(242, 243)))
+# 1: from master; 0: from outstation
+ProtocolSpec.register(ProtocolSpec('dnp3',
+    direction=DirectionByValue(ValueRule(3, shift=7, mask=0x01), requests=[1], responses=[0]),
+    keyword=KeywordByBytes(12, 13)))
+ProtocolSpec.register(ProtocolSpec('ftp',
+    direction=DirectionByPort([20, 21]),
+    keyword=KeywordByText(" |-|\r|\n")))
+# 9/10: not sure
+ProtocolSpec.register(ProtocolSpec('icmp',
+    direction=DirectionByValue(ValueRule(0), requests=[8, 13, 15, 17, 10], responses=[0, 3, 4, 5, 11, 12, 14, 16, 18, 9]),
+    keyword=KeywordByBytes(0, 2)))
+ProtocolSpec.register(ProtocolSpec('modbus',
+    direction=DirectionByPort([502]),
+    keyword=KeywordByBytes(7, 8)))
+# 1: symmetric active; 2: Symmetric Passive; 3: client; 4: server; 5: broadcast server; 6: Broadcast Client
+ProtocolSpec.register(ProtocolSpec('ntp',
+    direction=DirectionByValue(ValueRule(0, mask=0x07), requests=[1, 3, 5], responses=[2, 4, 6]),
+    keyword=KeywordByValue(ValueRule(0, mask=0x07))))
+ProtocolSpec.register(ProtocolSpec('smb',
+    direction=DirectionByValue(ValueRule(4+9, mask=0x80), requests=[0], responses=[128]),
+    keyword=KeywordByValue(ValueRule(4+4))))
+ProtocolSpec.register(ProtocolSpec('smb2',
+    direction=DirectionByValue(ValueRule(4+16, size=4, byteorder='little', mask=0x1), requests=[0], responses=[1]),
+    keyword=KeywordByValue(ValueRule(4+12, size=2, byteorder='little'))))
+# the direction of tftp is decided by sessions
+ProtocolSpec.register(ProtocolSpec('tftp',
+    keyword=KeywordByBytes(0, 2)))
+# g: 103; r: 114; n: 110
+ProtocolSpec.register(ProtocolSpec('zeroaccess',
+    direction=DirectionByValue(ValueRule(7), requests=[103], responses=[114, 110]),
+    keyword=KeywordByBytes(4, 8)))
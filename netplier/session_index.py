@@ -0,0 +1,78 @@
+# This file is part of NetPlier, a tool for binary protocol reverse engineering.
+# Copyright (C) 2021 Yapeng Ye
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>
+
+import logging
+import numpy as np
+
+from flow_table import FlowTable
+from partition import Partition
+from aligned_messages import AlignedMessages
+
+"""
+Session index of a trace, built once and shared by the constraints
+flow_table: the sessions of the messages (FlowTable, built from the messages if it is not given)
+session_ids: the session id of each message
+order/offsets: the message indexes of session i (sorted by date) are order[offsets[i]:offsets[i+1]]
+direction: the direction of each message (0: request; 1: response)
+pairs: the (request, response) message index pairs, see get_request_response_pairs
+"""
+class SessionIndex:
+
+    def __init__(self, messages, direction_list, flow_table=None):
+        self.direction = np.array(direction_list, dtype=np.int8)
+        self.dict_mid_i = dict() # message.id -> message index
+        for i,message in enumerate(messages):
+            self.dict_mid_i[message.id] = i
+
+        flow_table = flow_table if flow_table is not None else FlowTable(messages)
+        assert len(flow_table.session_ids) == len(messages), "The flow table is not built from the messages"
+        self.session_ids = flow_table.session_ids
+        self.order = flow_table.order
+        self.offsets = flow_table.offsets
+        self.pairs = None
+        logging.debug("Number of sessions: {0}".format(self.get_num_sessions()))
+
+    def get_num_sessions(self):
+        return len(self.offsets) - 1
+
+    # symbols -> the symbol index of each message (-1: not in any symbol)
+    # symbols: Partition (with its messages) or {name: Symbol}
+    def get_labels(self, symbols):
+        partition = symbols if isinstance(symbols, Partition) else Partition.from_symbols(symbols)
+        labels = np.full(len(self.session_ids), -1, dtype=np.int64)
+        if isinstance(partition.messages, AlignedMessages):
+            labels[partition.messages.indexes] = partition.labels
+        else:
+            labels[[self.dict_mid_i[message.id] for message in partition.messages]] = partition.labels
+
+        return labels
+
+    # (preceding request, response) message index pairs of all sessions
+    # in each session, every response after the first request is paired with the latest request before it
+    def get_request_response_pairs(self):
+        if self.pairs is None:
+            num = len(self.order)
+            is_request = self.direction[self.order] == 0
+            positions = np.arange(num)
+            session_starts = np.repeat(self.offsets[:-1], np.diff(self.offsets))
+
+            # the position of the latest request (in order) before each message
+            positions_request = np.maximum.accumulate(np.where(is_request, positions, -1)) if num > 0 else positions
+            is_paired = (~is_request) & (positions_request >= session_starts)
+
+            self.pairs = (self.order[positions_request[is_paired]], self.order[is_paired])
+
+        return self.pairs